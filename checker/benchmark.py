@@ -0,0 +1,148 @@
+"""
+End to end benchmarks of the checker over synthetic templates.
+
+For each size a template is generated and timed through: load (opening the
+workbook and triaging its sheets), check, as_json, report and, where the
+App Engine SDK is importable, storing the findings in a testbed datastore.
+Results are written as JSON, so runs can be compared between commits.
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+
+from check_content_sheet import ContentSheetChecker, RULESET_VERSION
+from readers import open_workbook
+from template_generator import generate_template
+
+# (concept tabs, rows on the Generic tab)
+SIZES = [(2, 25), (5, 100), (10, 500), (20, 2000)]
+
+def timed(func, repeat):
+  """
+  Best of repeat runs of func, in seconds, and the result of the last run
+  """
+  best = None
+  for _ in range(repeat):
+    started = time.time()
+    result = func()
+    elapsed = time.time() - started
+    if best is None or elapsed < best:
+      best = elapsed
+  return (best, result)
+
+def datastore_testbed():
+  """
+  An activated testbed with a datastore stub, or None without the SDK
+  """
+  try:
+    from google.appengine.ext import testbed
+  except ImportError:
+    return None
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(USER_EMAIL="benchmark@example.com", USER_ID="1", overwrite=True)
+  bed.init_datastore_v3_stub()
+  bed.init_memcache_stub()
+  bed.init_user_stub()
+  return bed
+
+def persist(issues, sheet):
+  """
+  The persistence path of an upload: a CheckLog and its findings
+  """
+  import model
+  checklog = model.CheckLog(sheet=sheet)
+  checklog.put()
+  return model.record_findings(checklog, issues)
+
+def commit():
+  """
+  The commit being benchmarked, if run from a git checkout
+  """
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                   cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run_benchmark(sizes=SIZES, repeat=3, options={}, seed=1):
+  """
+  Benchmark each (concept tabs, rows) size, returning the results
+  """
+  workdir = tempfile.mkdtemp(prefix="share_benchmark")
+  cwd = os.getcwd()
+  bed = datastore_testbed()
+  results = []
+  try:
+    # report() saves into the working directory
+    os.chdir(workdir)
+    for (concepts, rows) in sizes:
+      path = os.path.join(workdir, "SYNTHETIC Template.xlsx")
+      generate_template(path, concepts=concepts, rows=rows, seed=seed)
+      def load():
+        workbook = open_workbook(path)
+        checker = ContentSheetChecker(**options)
+        return [x for x in workbook.sheet_names if checker.open_sheet(workbook, x) is not None]
+      def check():
+        checker = ContentSheetChecker(**options)
+        checker.load_from_file(path)
+        return checker
+      timings = {}
+      (timings['load'], _) = timed(load, repeat)
+      (timings['check'], checker) = timed(check, repeat)
+      (timings['as_json'], _) = timed(checker.as_json, repeat)
+      (timings['report'], _) = timed(checker.report, repeat)
+      if bed is not None:
+        issues = checker.as_dict()
+        (timings['persist'], _) = timed(lambda: persist(issues, os.path.basename(path)), repeat)
+      else:
+        timings['persist'] = None
+      results.append({'concepts' : concepts,
+                      'rows' : rows,
+                      'bytes' : os.path.getsize(path),
+                      'findings' : len(checker.findings),
+                      'seconds' : timings})
+  finally:
+    os.chdir(cwd)
+    if bed is not None:
+      bed.deactivate()
+    shutil.rmtree(workdir, ignore_errors=True)
+  return {'commit' : commit(),
+          'ruleset_version' : RULESET_VERSION,
+          'python' : platform.python_version(),
+          'date' : time.strftime("%Y-%m-%dT%H:%M:%S"),
+          'repeat' : repeat,
+          'options' : dict((x, y) for (x, y) in options.iteritems() if x != 'profile'),
+          'datastore' : bed is not None,
+          'results' : results}
+
+if __name__ == "__main__":
+  import optparse
+  parser = optparse.OptionParser()
+  parser.add_option("-o", "--output", dest="output", default=None, action="store",
+                    help="file to write the JSON results to")
+  parser.add_option("-r", "--repeat", dest="repeat", default=3, type="int", action="store",
+                    help="runs per measurement, the best is kept")
+  parser.add_option("--size", dest="sizes", default=[], action="append",
+                    help="CONCEPTS:ROWS to benchmark, may be repeated")
+  parser.add_option("-c", "--columnar", dest="columnar", default=False, action="store_true")
+  (opts, args) = parser.parse_args()
+  sizes = [tuple([int(y) for y in x.split(":")]) for x in opts.sizes] or SIZES
+  results = run_benchmark(sizes, opts.repeat, {'columnar' : opts.columnar})
+  output = opts.output or "Content_Template_Benchmark_%s.json" % time.strftime("%Y-%m-%d")
+  with open(output, "w") as benchmark_json:
+    json.dump(results, benchmark_json, indent=2, sort_keys=True)
+  print "%8s %8s %10s %8s %8s %8s %8s %8s" % ("Concepts", "Rows", "Findings", "Load", "Check",
+                                             "JSON", "Report", "Persist")
+  for result in results['results']:
+    seconds = result['seconds']
+    print "%8d %8d %10d %8.3f %8.3f %8.3f %8.3f %8s" % (result['concepts'], result['rows'], result['findings'],
+                                                       seconds['load'], seconds['check'], seconds['as_json'],
+                                                       seconds['report'],
+                                                       "-" if seconds['persist'] is None else "%.3f" % seconds['persist'])
+  print "Results written to %s" % output
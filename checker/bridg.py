@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+An index of the BRIDG model: the attributes of each class (inherited ones
+included), the datatype of each attribute and the C-codes of classes and
+attributes.
+
+The index is built from a flat export of the model, a CSV of one row per
+attribute with the columns Class, Superclass, Attribute, Datatype, Class
+C-Code and Attribute C-Code, and bundled as JSON in data/ under the BRIDG
+version.  It is loaded once, at import of the checker, into dicts so the
+mappings of each row are checked by lookup.
+
+  python bridg.py -v 3.0.3 "BRIDG 3.0.3 Attributes.csv"
+"""
+
+import os
+import csv
+import json
+
+# where the bundled indices are kept
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+def index_path(version):
+  return os.path.join(DATA, "bridg-%s.json" % version)
+
+class BridgModel(object):
+  """
+  Classes to their attributes, and (class, attribute) to datatype and C-code
+  """
+
+  def __init__(self, version, classes, codes):
+    self.version = version
+    # class -> {attribute : [datatype, C-code]}
+    self.classes = classes
+    # class -> C-code
+    self.codes = codes
+    self.datatypes = frozenset([x[0] for attributes in classes.itervalues() for x in attributes.itervalues()])
+
+  def has_class(self, name):
+    return name in self.classes
+
+  def has_attribute(self, name, attribute):
+    return attribute in self.classes.get(name, ())
+
+  def datatype(self, name, attribute):
+    """
+    The ISO 21090 datatype of a class attribute, None if it isn't one
+    """
+    return self.classes.get(name, {}).get(attribute, (None, None))[0]
+
+  def code(self, name, attribute=None):
+    """
+    The C-code of a class, or of one of its attributes
+    """
+    if attribute is None:
+      return self.codes.get(name)
+    return self.classes.get(name, {}).get(attribute, (None, None))[1]
+
+  def dump(self):
+    return {'version' : self.version, 'classes' : self.classes, 'codes' : self.codes}
+
+  def save(self, path=None):
+    with open(path or index_path(self.version), "w") as index:
+      json.dump(self.dump(), index, separators=(',', ':'), sort_keys=True)
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as index:
+      dumped = json.load(index)
+    return cls(dumped['version'], dumped['classes'], dumped['codes'])
+
+def load_model(version):
+  """
+  The bundled BridgModel of a BRIDG version, None if there isn't one
+  """
+  path = index_path(version)
+  if not os.path.exists(path):
+    return None
+  return BridgModel.load(path)
+
+def build_model(rows, version):
+  """
+  A BridgModel from rows of the flat export (as dicts), with the attributes
+  of each superclass copied into its subclasses
+  """
+  declared = {}
+  parents = {}
+  codes = {}
+  for row in rows:
+    name = row['Class'].strip()
+    if not name:
+      continue
+    attributes = declared.setdefault(name, {})
+    if row.get('Superclass', '').strip():
+      parents[name] = row['Superclass'].strip()
+    if row.get('Class C-Code', '').strip():
+      codes[name] = row['Class C-Code'].strip()
+    if row.get('Attribute', '').strip():
+      attributes[row['Attribute'].strip()] = [row.get('Datatype', '').strip(),
+                                              row.get('Attribute C-Code', '').strip() or None]
+  classes = {}
+  def flatten(name, seen=()):
+    if name not in classes:
+      attributes = {}
+      if name in parents and parents[name] in declared and parents[name] not in seen:
+        attributes.update(flatten(parents[name], seen + (name,)))
+      attributes.update(declared.get(name, {}))
+      classes[name] = attributes
+    return classes[name]
+  for name in declared:
+    flatten(name)
+  return BridgModel(version, classes, codes)
+
+def read_export(path):
+  """
+  The rows of a CSV export of the model, as unicode dicts
+  """
+  with open(path, "rb") as export:
+    return [dict((x.decode('utf-8').strip(), (y or '').decode('utf-8')) for (x, y) in row.iteritems())
+            for row in csv.DictReader(export)]
+
+if __name__ == "__main__":
+  import optparse
+  parser = optparse.OptionParser(usage="%prog [options] EXPORT.csv")
+  parser.add_option("-v", "--version", dest="version", default="3.0.3", action="store",
+                    help="BRIDG version of the export")
+  parser.add_option("-o", "--output", dest="output", default=None, action="store",
+                    help="file to write the index to (default: data/bridg-VERSION.json)")
+  (opts, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("expected the CSV export of the model")
+  model = build_model(read_export(args[0]), opts.version)
+  if not os.path.exists(DATA) and opts.output is None:
+    os.makedirs(DATA)
+  model.save(opts.output)
+  print "Indexed %s classes, %s attributes of BRIDG %s" % (len(model.classes),
+                                                          sum([len(x) for x in model.classes.itervalues()]),
+                                                          opts.version)
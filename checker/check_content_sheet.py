@@ -11,6 +11,8 @@ import time
 import re
 import inspect
 import json
+import hashlib
+import logging
 
 # XML Spreadsheet format
 import openpyxl
@@ -19,12 +21,49 @@ from openpyxl.style import Color, Fill
 from openpyxl.cell import Cell
 from openpyxl.cell import get_column_letter
 
+from columnar import ColumnTable, available as columnar_available
+from readers import open_workbook
+from profiling import Profile
+from findings import FindingStore
+from normalize import si
+from bridg import load_model, index_path
+
 """
 Extract content from an unknown state
 """
 
 BRIDG_VERSION = "3.0.3"
 
+# the modules deciding which findings are made and how they read: the
+# rules, the readers and normalisation of cells, the column engine, the
+# rendering of messages and the BRIDG and terminology indices
+RULESET_MODULES = ["check_content_sheet", "readers", "normalize", "columnar", "findings", "bridg",
+                   "terminology"]
+
+def _ruleset_version():
+  """
+  Digest of the source of the RULESET_MODULES and the bundled BRIDG index,
+  so anything keyed on the rules is dropped whenever the tables, rules,
+  readers or model change
+  """
+  here = os.path.dirname(os.path.abspath(__file__))
+  digest = hashlib.sha1()
+  for module in RULESET_MODULES:
+    with open(os.path.join(here, module + ".py"), 'rb') as module_source:
+      digest.update(module_source.read())
+  if os.path.exists(index_path(BRIDG_VERSION)):
+    with open(index_path(BRIDG_VERSION), 'rb') as bridg_index:
+      digest.update(bridg_index.read())
+  return digest.hexdigest()[:12]
+
+RULESET_VERSION = _ruleset_version()
+
+# the index of the BRIDG model, None if it isn't bundled
+BRIDG_MODEL = load_model(BRIDG_VERSION)
+if BRIDG_MODEL is None:
+  logging.warning("No index of BRIDG %s at %s, the BRIDG classes and attributes won't be checked"
+                  % (BRIDG_VERSION, index_path(BRIDG_VERSION)))
+
 # General Dictionary of codes to 
 MAPPING_CODES = {'Mapping to BRIDG Defined Class' : 'BRIDG Defined Class C-Code',
                  'Mapping to BRIDG Defined Class Attribute' : 'BRIDG Defined Class Attribute C-Code',
@@ -48,6 +87,11 @@ MAPPING_ORDER = ['Variable Name',
                 'ISO 21090 Datatype Constraint', 
                 'Description of Observation, ObservationResult or Activity or Relationship - CODED VALUES']
 
+# (class, attribute, class C-code, attribute C-code) columns of each BRIDG mapping
+BRIDG_CLASSES = [(u'Mapping to BRIDG %s Class' % x, u'Mapping to BRIDG %s Class Attribute' % x,
+                  u'BRIDG %s Class C-Code' % x, u'BRIDG %s Class Attribute C-Code' % x)
+                 for x in ['Defined', 'Performed', 'Non-defined/Non-performed', 'Planned']]
+
 COLUMNS = {"GENERIC" : [u'Variable Name',
                         u'Variable Name C-Code',
                         u'Variable Label',
@@ -177,54 +221,284 @@ def columnify(set_of_columns):
     mapped["%s%s" % (prefix, chr(65 + idx % 26))] = col
   return mapped
 
-def si(content):
+# Kinds of compiled check
+BLANK = 0           # column is blank
+BLANK_IF_EQUALS = 1 # column is blank and another column has a value
+BLANK_IF_SET = 2    # column is blank and another column is set
+BLANK_IF_NONE = 3   # column is blank and none of a group of columns is set
+NOT_BLANK = 4       # column is set
+SET_IF_EQUALS = 5   # column is set and another column has a value
+UNCODED = 6         # term column is set (not na) and its C-code column is blank
+BOTH_SET = 7        # both columns of a mutually exclusive pair hold a value
+
+class RulePlan(object):
   """
-  If it gets a None, return '', else return cleaned string
+  The rule tables (MUSTSET, MUSTVALORNA, MUSTNOTSET, REVERSE_DEPS,
+  MAPPING_CODES, MUTEX) compiled against one header layout.
+
+  Every check is resolved to column indices up front, so a row is checked
+  as a plain tuple in one pass.  Rows are padded with a trailing None and
+  columns missing from the layout point at it, as dict.get would.
   """
-  import types
-  if isinstance(content, openpyxl.cell.Cell):
-    if isinstance(content.value, types.NoneType):
-        return unicode('')
-    else:
-        return unicode(content.value).strip()
-  elif isinstance(content, xlrd.sheet.Cell):
-    if content.ctype == xlrd.sheet.XL_CELL_EMPTY:
-        return unicode('')
-    else:
-        return unicode(content.value).strip()
-  return unicode(content).strip()
+
+  # the table driven rules, as presented on the rules page
+  specifications = ["Checks that a column is populated when it should be",
+                    "Check that field is set or NA",
+                    "Check that a column is not set",
+                    "Check that a dependent column is missing if 'depends on' is not set, or set to a value excluding setting",
+                    "Check that all codable elements have been coded",
+                    "Check that only one of a pair of mutually exclusive columns holds a value"]
+
+  def __init__(self, columns):
+    self.columns = tuple(columns)
+    self.width = len(self.columns)
+    self.index = dict((column, idx) for (idx, column) in enumerate(self.columns))
+    self.name = self.position(u'Variable Name')
+    self.bridg_mappings = [idx for (column, idx) in self.index.iteritems() if column.startswith("Mapping to BRIDG")]
+    # (term, C-code, C-code column) of the MAPPING_CODES pairs in the layout
+    self.coded = [(self.index[x], self.index[y], y) for (x, y) in MAPPING_CODES.iteritems()
+                  if x in self.index and y in self.index]
+    # the BRIDG_CLASSES columns in the layout, as positions followed by names
+    self.bridg_classes = [tuple([self.position(y) for y in x]) + x for x in BRIDG_CLASSES if x[0] in self.index]
+    self.datatype = self.position(u'ISO 21090 Datatype')
+    # the coded terms, for the usage of each term
+    self.terms = sorted([self.index[x] for x in MAPPING_CODES if x in self.index])
+    self.checks = self._compile()
+    self._projections = {}
+
+  def position(self, column):
+    """
+    Index of a column in a padded row (the trailing None if not in the layout)
+    """
+    return self.index.get(column, self.width)
+
+  def _compile(self):
+    checks = []
+    for column in [x for x in self.columns if x in self.index]:
+      idx = self.index[column]
+      must_set = MUSTSET.get(column)
+      if must_set == True:
+        checks.append((BLANK, idx, column, None, "Column must be set"))
+      elif must_set:
+        for (depval, dep) in must_set.iteritems():
+          if isinstance(dep, basestring):
+            message = "Column must be set but is not - based on dependency of '%s' having value %s" % (dep, depval)
+            checks.append((BLANK_IF_EQUALS, idx, column, (self.position(dep), depval), message))
+            if depval == "SET":
+              checks.append((BLANK_IF_SET, idx, column, self.position(dep), message))
+          elif isinstance(dep, list) and depval == "SET":
+            message = "Column must be set but is not - based on dependency of '%s' having value %s" % (','.join(dep), depval)
+            checks.append((BLANK_IF_NONE, idx, column, [self.position(x) for x in dep], message))
+      if MUSTVALORNA.get(column, False) == True:
+        checks.append((BLANK, idx, column, None, "Column must be set to value or na"))
+      if MUSTNOTSET.get(column, False) == True:
+        checks.append((NOT_BLANK, idx, column, None, "Column is set when it shouldn't be"))
+    for (column, dependencies) in REVERSE_DEPS.iteritems():
+      for (col_dep, dep_val) in dependencies.iteritems():
+        checks.append((SET_IF_EQUALS, self.position(column), column, (self.position(col_dep), dep_val),
+                       "Should not be set, as is a dependent variable"))
+    for (target, targetted) in MAPPING_CODES.iteritems():
+      checks.append((UNCODED, self.position(targetted), targetted, self.position(target), "Expected Coding is missing"))
+    for (first, second) in MUTEX:
+      if first in self.index and second in self.index:
+        checks.append((BOTH_SET, self.index[first], first, self.index[second],
+                       "Column is set, but so is '%s' - only one of them should hold a value" % second))
+    return checks
+
+  def pad(self, values):
+    """
+    Cut or pad a list of cleaned cell values to the padded row length
+    """
+    values = values[:self.width]
+    return tuple(values) + (None,) * (self.width + 1 - len(values))
+
+  def projection(self, rules):
+    """
+    Positions of the columns read by the compiled checks and by the rules,
+    or None if any rule hasn't declared what it reads
+    """
+    key = tuple([x.__name__ for x in rules])
+    if key not in self._projections:
+      read = set([self.name] + self.bridg_mappings + self.terms)
+      for (kind, idx, column, arg, message) in self.checks:
+        read.add(idx)
+        if isinstance(arg, int):
+          read.add(arg)
+        elif isinstance(arg, tuple):
+          read.add(arg[0])
+        elif isinstance(arg, list):
+          read.update(arg)
+      for rule in rules:
+        if getattr(rule, 'reads', None) is None:
+          read = None
+          break
+        for column in rule.reads:
+          if column.endswith('*'):
+            read.update([idx for (name, idx) in self.index.iteritems() if name.startswith(column[:-1])])
+          else:
+            read.add(self.position(column))
+      if read is not None:
+        read = sorted([x for x in read if x < self.width])
+      self._projections[key] = read
+    return self._projections[key]
+
+  def run(self, row, log):
+    """
+    Run every compiled check over a padded row, passing findings to log
+    """
+    name = row[self.name]
+    for (kind, idx, column, arg, message) in self.checks:
+      value = row[idx]
+      if kind == BLANK:
+        failed = value == ""
+      elif kind == BLANK_IF_EQUALS:
+        failed = value == "" and row[arg[0]] == arg[1]
+      elif kind == BLANK_IF_SET:
+        # the 'equals' check above has already reported a literal "SET"
+        failed = value == "" and row[arg] != "" and row[arg] != "SET"
+      elif kind == BLANK_IF_NONE:
+        failed = value == "" and [row[x] for x in arg].count("") == len(arg)
+      elif kind == NOT_BLANK:
+        failed = value != ""
+      elif kind == SET_IF_EQUALS:
+        failed = value != "" and row[arg[0]] == arg[1]
+      elif kind == UNCODED:
+        failed = value == "" and not row[arg] in ["", "na"]
+      elif kind == BOTH_SET:
+        failed = value not in ["", "NA", "na"] and row[arg] not in ["", "NA", "na"]
+      if failed:
+        log(name, column, message)
+
+  def run_columns(self, table, log):
+    """
+    Run every compiled check over a columnar.ColumnTable of padded rows as
+    column masks, passing findings with the position of their row to log,
+    in row order
+    """
+    names = table.column(self.name)
+    found = []
+    for (order, (kind, idx, column, arg, message)) in enumerate(self.checks):
+      if kind == BLANK:
+        mask = table.blank(idx)
+      elif kind == BLANK_IF_EQUALS:
+        mask = table.blank(idx) & table.equals(arg[0], arg[1])
+      elif kind == BLANK_IF_SET:
+        mask = table.blank(idx) & ~table.blank(arg) & ~table.equals(arg, "SET")
+      elif kind == BLANK_IF_NONE:
+        mask = table.blank(idx) & table.every([table.blank(x) for x in arg])
+      elif kind == NOT_BLANK:
+        mask = ~table.blank(idx)
+      elif kind == SET_IF_EQUALS:
+        mask = ~table.blank(idx) & table.equals(arg[0], arg[1])
+      elif kind == UNCODED:
+        mask = table.blank(idx) & ~table.blank(arg) & ~table.equals(arg, "na")
+      elif kind == BOTH_SET:
+        mask = ~(table.blank(idx) | table.is_na(idx)) & ~(table.blank(arg) | table.is_na(arg))
+      for position in table.positions(mask):
+        found.append((position, order, column, message))
+    found.sort()
+    for (position, order, column, message) in found:
+      log(position, names[position], column, message)
+
+def reads(*columns):
+  """
+  Declare the columns a rule reads (a trailing * matches by prefix), so
+  the reader can skip the rest
+  """
+  def declare(rule):
+    rule.reads = columns
+    return rule
+  return declare
+
+# compiled plans, by header layout
+_PLANS = {}
+
+def compile_rules(columns):
+  """
+  Get the RulePlan for a header layout, compiling it on first use
+  """
+  columns = tuple(columns)
+  if columns not in _PLANS:
+    _PLANS[columns] = RulePlan(columns)
+  return _PLANS[columns]
 
 class ContentSheetChecker(object):
 
-  def __init__(self):
+  def __init__(self, columnar=False, workers=1, cache=None, profile=None, terminology=None):
+    # columnar collects each sheet and runs the rule tables as column masks
+    if columnar and not columnar_available():
+      raise ValueError("The columnar engine needs numpy")
+    self.columnar = columnar
+    # concept tabs are checked across this many workers once the Generic tab is done
+    self.workers = workers
+    # a result_cache.ResultCache of sheet results, so unchanged sheets are not re-checked
+    self.cache = cache
+    # a profiling.Profile collecting per rule and per phase timings
+    self.profile = profile
+    # a terminology.TerminologyIndex the C-codes are checked against, if any
+    self.terminology = terminology
+    self._rules = []
+    self._get_rules()
+    self.reset()
+
+  def reset(self):
+    """
+    Drop the state of previous checks, keeping the options and rules, so
+    a long running checker can take the next job
+    """
+    # findings logged so far, to attribute them to rules
+    self.logged = 0
     self.templates = []
     self.template_vars = {}
-    self.exceptions = {}
+    self.findings = FindingStore()
     self.template = ""
     self.sheet = ""
-    self._rules = []
-    self._get_rules()
+    self.plan = None
+    # variables of the current template's Generic tab, once it has been checked
+    self.generic_index = None
+    # the coded terms each template uses, to the sheets using them
+    self.term_usage = {}
+    # why each workbook that couldn't be opened failed, by template
+    self.failures = {}
+    # findings held back while a sheet is checked column-wise
+    self._held = None
   
   @property
   def has_issues(self):
-    return len(self.exceptions) != 0
+    return len(self.findings) != 0
+
+  @property
+  def exceptions(self):
+    """
+    the issues as lists of [sheet, field, column, message], by template
+    """
+    return dict((template, self.findings.issues(template)) for template in self.findings.templates())
           
-  def log(self, field, column, message):
-    # Log an exception
-    self.exceptions.setdefault(self.template, []).append([self.sheet, field, column, message])
+  def log(self, field, column, message, *args):
+    # Log an exception - message is only formatted with args when rendered
+    if self._held is not None:
+      self._held.append((field, column, message, args))
+      self.logged += 1
+      return
+    if self.profile is not None:
+      started = time.time()
+      self.findings.add(self.template, self.sheet, field, column, message, args)
+      self.profile.phase("log", time.time() - started)
+    else:
+      self.findings.add(self.template, self.sheet, field, column, message, args)
+    self.logged += 1
 
   def as_dict(self):
     """
     serialise the issues as a list of dicts
     """
     serialised = []
-    for (template, issues) in self.exceptions.iteritems():
-      for issue in issues:
-        serialised.append({'template' : template,
-                            'sheet' : issue[0],
-                            'field' : issue[1],
-                            'column' : issue[2],
-                            'message' : issue[3]})
+    for (template, sheet, field, column, message) in self.findings:
+      serialised.append({'template' : template,
+                          'sheet' : sheet,
+                          'field' : field,
+                          'column' : column,
+                          'message' : message})
     return serialised
     
   def as_json(self):
@@ -232,11 +506,35 @@ class ContentSheetChecker(object):
     return the issues as a json dump
     """
     return json.dumps(self.as_dict())
+
+  def dump(self):
+    """
+    serialise the state of a run, to be merged into another checker
+    """
+    return {'templates' : self.templates,
+            'findings' : self.findings.dump(),
+            'template_vars' : self.template_vars,
+            'term_usage' : self.term_usage,
+            'profile' : self.profile}
+
+  def merge(self, state):
+    """
+    fold the dumped state of another run into this one
+    """
+    self.templates.extend(state['templates'])
+    self.findings.merge(state['findings'])
+    for (template, variables) in state['template_vars'].iteritems():
+      self.template_vars.setdefault(template, []).extend(variables)
+    for (template, usage) in state['term_usage'].iteritems():
+      self._merge_usage(template, usage)
+    if self.profile is not None and state.get('profile') is not None:
+      self.profile.merge(state['profile'])
       
   def report(self, exceptions=[]):
-    if len(self.exceptions) > 0:
+    if self.has_issues:
       report = Workbook()
-      for (contentbook, exceptions) in self.exceptions.iteritems():
+      for contentbook in self.findings.templates():
+        exceptions = self.findings.issues(contentbook)
         fname = os.path.basename(contentbook)
         template = os.path.splitext(fname)[0]
         if "Sheet" in report.get_sheet_names():
@@ -294,64 +592,219 @@ class ContentSheetChecker(object):
     """
     List the rules in action
     """
-    return [x.__doc__ for x in self._rules]
+    specifications = []
+    for rule in self._rules:
+      if rule == self._run_rule_plan:
+        specifications.extend(RulePlan.specifications)
+      elif rule == self._run_check_bridg_attributes_classes and BRIDG_MODEL is None:
+        specifications.append("%s (unavailable: no index of BRIDG %s is bundled)"
+                              % (rule.__doc__.strip(), BRIDG_VERSION))
+      else:
+        specifications.append(rule.__doc__)
+    return specifications
     
   def load_from_mem(self, memobj):
-    self.templates.append(memobj.filename)
-    self.template = memobj.filename
-
-    try:
-      workbook = openpyxl.reader.excel.load_workbook(memobj.file)
-    except Exception, e:
-      import traceback
-      print 'Failed to open %s : %s' % (memobj.filename, e)
-      traceback.print_tb(sys.exc_info()[2])
-      return
-    for sheet_name in workbook.get_sheet_names():
-      sheet = workbook.get_sheet_by_name(sheet_name)
-      self.sheet = sheet_name
-      if sheet.cell("A1").value.upper() not in ["BRIDG VERSION", "CONCEPT"]:
-        # Only look at those with a BRIDG Version top left
-        continue
-      if sheet.cell("C1").value and sheet.cell("C1").value.upper() == "WIP":
-        self.log("ALL", "ALL", "Sheet has been marked as Work in Progress and has not been scanned")
-        continue
-      self.sheet = sheet_name
-      self.run_checks(sheet)
+    self.load_workbook(memobj.file, memobj.filename)
 
   def load_from_file(self, contentbook):
-    self.templates.append(contentbook)
-    self.template = contentbook
+    return self.load_workbook(contentbook, contentbook)
+
+  def load_workbook(self, source, name):
+    """
+    Check all the template sheets in a workbook (a path or a file-like
+    object); False if it couldn't be opened, the reason is in failures
+    """
+    self.templates.append(name)
+    self.template = name
+    self.generic_index = None
+    started = time.time()
     try:
-      workbook = openpyxl.reader.excel.load_workbook(contentbook)
+      workbook = open_workbook(source)
     except Exception, e:
       import traceback
-      print 'Failed to open %s : %s' % (contentbook, e)
+      print 'Failed to open %s : %s' % (name, e)
       traceback.print_tb(sys.exc_info()[2])
-      return
-    for sheet_name in workbook.get_sheet_names():
-      sheet = workbook.get_sheet_by_name(sheet_name)
-      self.sheet = sheet_name
-      if sheet.cell("A1").value.upper() not in ["BRIDG VERSION", "CONCEPT"]:
-        # Only look at those with a BRIDG Version top left
-        continue
-      if sheet.cell("C1").value and sheet.cell("C1").value.upper() == "WIP":
-        self.log("ALL", "ALL", "Sheet has been marked as Work in Progress and has not been scanned")
+      self.failures[name] = "%s: %s" % (e.__class__.__name__, e)
+      return False
+    if self.profile is not None:
+      self.profile.phase("load", time.time() - started)
+    # phase one checks the Generic tab, whatever its position, and freezes
+    # the variable index the concept tabs are checked against in phase two
+    concepts = []
+    for sheet_name in workbook.sheet_names:
+      rows = self.open_sheet(workbook, sheet_name)
+      if rows is None:
         continue
+      if 'GENERIC' in sheet_name.upper():
+        key = self._cache_key(workbook, sheet_name)
+        result = self._cached_result(key)
+        if result is None:
+          result = self._store_result(key, self._check_spawned(sheet_name, rows))
+        self._merge_result(result)
+        self.generic_index = frozenset(self.template_vars.get(self.template, []))
+      else:
+        concepts.append((sheet_name, rows))
+    keys = [self._cache_key(workbook, x[0]) for x in concepts]
+    results = [self._cached_result(x) for x in keys]
+    pending = [x for (x, result) in zip(concepts, results) if result is None]
+    states = iter(self._check_concepts(source, pending))
+    for (key, result) in zip(keys, results):
+      if result is None:
+        result = self._store_result(key, states.next())
+      self._merge_result(result)
+    return True
+
+  def open_sheet(self, workbook, sheet_name):
+    """
+    The rows of a sheet if it is a template to be checked, otherwise None.
+    Only the top row is read to decide, the rows are parsed as they are used
+    """
+    top = workbook.head(sheet_name)[0]
+    (a1, b1, c1) = ([si(x) for x in top[:3]] + ['', '', ''])[:3]
+    if a1.upper() not in ["BRIDG VERSION", "CONCEPT"]:
+      # Only look at those with a BRIDG Version top left
+      return None
+    if c1.upper() == "WIP":
       self.sheet = sheet_name
-      self.run_checks(sheet)
+      self.log("ALL", "ALL", "Sheet has been marked as Work in Progress and has not been scanned")
+      return None
+    return workbook.rows(sheet_name)
+
+  def check_sheet(self, sheet_name, rows):
+    """
+    Check the rows of a template sheet
+    """
+    self.sheet = sheet_name
+    self.run_checks(rows)
+
+  def spawn(self):
+    """
+    A checker for one concept tab of the current template, sharing the frozen Generic index
+    """
+    checker = ContentSheetChecker(columnar=self.columnar,
+                                  profile=None if self.profile is None else Profile(),
+                                  terminology=self.terminology)
+    checker.template = self.template
+    checker.generic_index = self.generic_index
+    return checker
+
+  def _check_spawned(self, sheet_name, rows):
+    """
+    Check a template sheet in a spawned checker, returning its dumped state
+    """
+    checker = self.spawn()
+    checker.check_sheet(sheet_name, rows)
+    return checker.dump()
+
+  def _check_concepts(self, source, concepts):
+    """
+    The dumped state of each concept tab, in order
+    """
+    if self.workers > 1 and len(concepts) > 1:
+      return self._check_in_parallel(source, concepts)
+    return [self._check_spawned(sheet_name, rows) for (sheet_name, rows) in concepts]
+
+  def _cache_key(self, workbook, sheet_name):
+    """
+    Key of a sheet's result: the rules, the sheet and its content, the
+    terminology version and for concept tabs the Generic variables they are
+    checked against
+    """
+    if self.cache is None:
+      return None
+    key = hashlib.sha1(RULESET_VERSION)
+    key.update(sheet_name.encode('utf-8'))
+    key.update(workbook.digest(sheet_name))
+    if self.generic_index is not None and not 'GENERIC' in sheet_name.upper():
+      key.update("generic:" + u'\n'.join(sorted(self.generic_index)).encode('utf-8'))
+    if self.terminology is not None:
+      key.update("terminology:%s" % self.terminology.version)
+    return key.hexdigest()
+
+  def _cached_result(self, key):
+    if key is None:
+      return None
+    return self.cache.get(key)
+
+  def _store_result(self, key, state):
+    """
+    Reduce the dumped state of a sheet to its result, caching it under key
+    """
+    if self.profile is not None and state.get('profile') is not None:
+      self.profile.merge(state['profile'])
+    findings = FindingStore()
+    findings.merge(state['findings'])
+    result = {'findings' : [list(x[1:]) for x in findings.raw(self.template)],
+              'variables' : state['template_vars'].get(self.template, []),
+              'terms' : state['term_usage'].get(self.template, {})}
+    if key is not None:
+      self.cache.put(key, result)
+    return result
+
+  def _merge_result(self, result):
+    """
+    Fold the result of a sheet into the current template
+    """
+    for (sheet, field, column, message, args) in result['findings']:
+      self.findings.add(self.template, sheet, field, column, message, args)
+    if result['variables']:
+      self.template_vars.setdefault(self.template, []).extend(result['variables'])
+    self._merge_usage(self.template, result['terms'])
+
+  def _merge_usage(self, template, usage):
+    for (term, sheets) in usage.iteritems():
+      self.template_usage(template).setdefault(term, []).extend(sheets)
+
+  def template_usage(self, template):
+    """
+    The coded terms used by a template, to the sheets using them
+    """
+    return self.term_usage.setdefault(template, {})
+
+  def _check_in_parallel(self, source, concepts):
+    """
+    Check the concept tabs across the workers, returning the dumped state of each tab in order.
+    Workbooks on disk are shared out to processes (unless already in a pool worker), others to threads
+    """
+    import multiprocessing
+    if isinstance(source, basestring) and not multiprocessing.current_process().daemon:
+      options = {'columnar' : self.columnar,
+                 'profile' : None if self.profile is None else Profile(),
+                 'terminology' : self.terminology}
+      pool = multiprocessing.Pool(min(self.workers, len(concepts)))
+      try:
+        return pool.map(check_concept_sheet,
+                        [(source, self.template, x[0], self.generic_index, options) for x in concepts])
+      finally:
+        pool.close()
+        pool.join()
+    import threading
+    states = [None] * len(concepts)
+    def work(positions):
+      for position in positions:
+        states[position] = self._check_spawned(*concepts[position])
+    threads = [threading.Thread(target=work, args=(range(x, len(concepts), self.workers),))
+               for x in range(min(self.workers, len(concepts)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return states
 
-  def run_checks(self, sheet):
+  def run_checks(self, rows):
     """
-    Run all checks 
+    Run all checks over the rows of a sheet, consuming them in a single pass
     """
+    rows = iter(rows)
+    profile = self.profile
+    started = time.time()
     COLS = []
-    for (offset, row) in enumerate(sheet.rows, 1):
+    for row in rows:
       if si(row[0]) == "":
         continue
       elif si(row[0]).upper() == "BRIDG VERSION":
         if not (si(row[1]) == BRIDG_VERSION or si(row[2]) == BRIDG_VERSION):
-            self.log("ALL", si(row[0]), "BRIDG Version not set or not equal to %s" % BRIDG_VERSION)
+            self.log("ALL", si(row[0]), "BRIDG Version not set or not equal to %s", BRIDG_VERSION)
       elif si(row[0]) == "Domain":
         if si(row[1]) == "":
             self.log("ALL", si(row[0]), "Domain not set")
@@ -365,160 +818,253 @@ class ContentSheetChecker(object):
           self.log("ALL", "HEADINGS", "Columns are incorrect: Please check")
           COLS = _COLS
         break
-    # yuck
-    for (row_idx, contentrow) in enumerate(sheet.rows[offset:], offset):
-      if int(row_idx) < int(offset):
-        continue
-      mapped = dict(zip(COLS, [si(x) for x in contentrow]))
-      if mapped.get('Variable Name') == "":
+    # the header has been consumed, the remainder are content rows
+    if profile is not None:
+      profile.phase("headers", time.time() - started)
+    self.plan = plan = compile_rules(COLS)
+    generic = 'GENERIC' in self.sheet.upper()
+    if self.columnar:
+      # the rule tables are run over the whole sheet once it is collected;
+      # the findings of the rules before and after them are held, to be
+      # logged with theirs in the order of the row engine
+      split = self.rules.index(self._run_rule_plan)
+      (rules, after) = (self.rules[:split], self.rules[split + 1:])
+      collected = []
+      ordered = []
+    else:
+      rules = self.rules
+    # only the columns the rules read are parsed from here on
+    projection = plan.projection(self.rules)
+    if projection is not None and hasattr(rows, 'project'):
+      rows.project(projection)
+    used = set()
+    for contentrow in rows:
+      # the readers give normalised values
+      row = plan.pad(contentrow)
+      if row[plan.name] == "":
         # skip blanks
         continue
-      if 'GENERIC' in self.sheet.upper():
+      if generic:
         # populate template vars on Generic Tab
-        self.template_vars.setdefault(self.template, []).append(mapped.get('Variable Name'))
-      for rule in self.rules:
-        rule.__call__(mapped)
+        self.template_vars.setdefault(self.template, []).append(row[plan.name])
+      if self.columnar:
+        self._held = []
+        self._apply_rules(rules, row)
+        ordered.extend([(len(collected), 0, x) for x in enumerate(self._held)])
+        self._held = []
+        self._apply_rules(after, row)
+        ordered.extend([(len(collected), 2, x) for x in enumerate(self._held)])
+        self._held = None
+        collected.append(row)
+      else:
+        self._apply_rules(rules, row)
+      used.update([row[x] for x in plan.terms])
+    for term in used.difference(["", "NA", "na"]):
+      self.template_usage(self.template).setdefault(term, []).append(self.sheet)
+    if self.columnar:
+      (logged, started) = (len(ordered), time.time())
+      def hold(position, field, column, message):
+        ordered.append((position, 1, (len(ordered), (field, column, message, ()))))
+      plan.run_columns(ColumnTable(collected, plan.width), hold)
+      if profile is not None:
+        profile.rule(self._run_rule_plan.__name__, time.time() - started, len(ordered) - logged)
+      ordered.sort()
+      for (position, phase, (order, finding)) in ordered:
+        self.log(finding[0], finding[1], finding[2], *finding[3])
+
+  def _apply_rules(self, rules, row):
+    if self.profile is None:
+      for rule in rules:
+        rule(row)
+    else:
+      for rule in rules:
+        (logged, started) = (self.logged, time.time())
+        rule(row)
+        self.profile.rule(rule.__name__, time.time() - started, self.logged - logged)
 
+  @reads(u'Variable Name', u'CDASH V1.1 Conceptual Datatype', u'Codelist Master')
   def _run_codelist_master(self, row):
     """
     Check that, when CDASH Conceptual Datatype is Enumerated, a CodeList Master is supplied, except for --CAT, --SCAT, VISIT
     """
-    if row.get("CDASH V1.1 Conceptual Datatype") == "Enumerated":
-      if row.get("Variable Name") in ["--SCAT", "--CAT", "VISIT"]:
+    if row[self.plan.position("CDASH V1.1 Conceptual Datatype")] == "Enumerated":
+      if row[self.plan.name] in ["--SCAT", "--CAT", "VISIT"]:
         return
-      if row.get("Codelist Master")  == "":
-        self.log(row.get("Variable Name"),
+      if row[self.plan.position("Codelist Master")] == "":
+        self.log(row[self.plan.name],
                 "Codelist Master",
                 "CDASH Datatype is Enumerated, but no Codelist Master is present")
-    
-  def _run_reverse_dependencies(self, row):
+
+  @reads()
+  def _run_rule_plan(self, row):
     """
-    Check that a dependent column is missing if 'depends on' is not set, or set to a value excluding setting
+    Run the rule tables, compiled for the header layout of the sheet
     """
-    for (col, dependencies) in REVERSE_DEPS.iteritems():
-      for (col_dep, dep_val) in dependencies.iteritems():
-        if row.get(col_dep) == dep_val:
-          if row.get(col) != "": 
-            self.log(row.get('Variable Name'),
-                  col,
-                  "Should not be set, as is a dependent variable")
+    self.plan.run(row, self.log)
 
+  @reads(u'Variable Name', u'Mapping to BRIDG*')
   def _run_check_bridg_is_set(self, row):
     """
     Check that at least one BRIDG attribute is set (except for DOMAIN)
     """
     # isolate BRIDG columns
-    cols = [x for x in row.keys() if x.startswith("Mapping to BRIDG")]
+    cols = self.plan.bridg_mappings
     if len(cols) == 0:
       return
-    set_values = [row.get(x) for x in cols if row.get(x) != ""]
+    set_values = [row[x] for x in cols if row[x] != ""]
     if len(set_values) == 0:
-      self.log(row.get("Variable Name"),
+      self.log(row[self.plan.name],
                       "BRIDG Mappings",
-                      "No BRIDG Mapping currently assigned to %s" % row.get('Variable Name'))
+                      "No BRIDG Mapping currently assigned to %s", row[self.plan.name])
         
       
+  @reads(u'Variable Name')
   def _run_check_copying_from_generic(self, row):
     """
     Check that all fields in the Concept Tabs are represented in the Generic Tab
     """
-    if not 'GENERIC' in self.sheet.upper():
-      try:
-        if not row.get('Variable Name') in self.template_vars.get(self.template):
-          self.log(row.get("Variable Name"),
-                   "Variable name",
-              "Variable %s is in a Concept Tab, but not in the Generic Tab" % row.get('Variable Name'))
-      except TypeError:
-        #print "Template Vars: %s" % self.template_vars.get(self.template)
-        pass
+    if self.generic_index is not None and not 'GENERIC' in self.sheet.upper():
+      if not row[self.plan.name] in self.generic_index:
+        self.log(row[self.plan.name],
+                 "Variable name",
+            "Variable %s is in a Concept Tab, but not in the Generic Tab", row[self.plan.name])
     
-  def _run_check_bridg_attributes_classes(self, row):
+  @reads(*(MAPPING_CODES.keys() + MAPPING_CODES.values()))
+  def _run_check_coding_values(self, row):
     """
-    Check that the BRIDG classes/attributes are valid values
+    Check that the C-codes given agree with the codes assigned in the terminology
     """
-    pass
-                  
-  def _run_set_check(self, row):
-    """
-    Checks that a column is populated when it should be
-    """
-    for (column, content) in row.iteritems():
-      if MUSTSET.get(column):
-        # column flagged as needing setting
-        if content == "":
-          # nothing set
-          if MUSTSET.get(column) == True:
-            self.log(row.get('Variable Name'),
-                     column,
-                     "Column must be set")
-          else:
-            # check the dependency
-            for (depval, dep) in MUSTSET.get(column, {}).iteritems():
-              # Dep is a dependent column, and deplval is a value that should be set
-              if isinstance(dep, str):
-                if row.get(dep) == depval:
-                  self.log(row.get('Variable Name'),
-                           column,
-                      "Column must be set but is not - based on dependency of '%s' having value %s" % (dep, depval))
-                elif (depval == "SET" and row.get(dep) != ""):
-                  self.log(row.get('Variable Name'),
-                           column,
-                      "Column must be set but is not - based on dependency of '%s' having value %s" % (dep, depval))
-              elif isinstance(dep, list):
-                if depval == "SET":
-                  assigned = [row.get(x) for x in dep]
-                  if assigned.count("") == len(assigned):
-                    self.log(row.get('Variable Name'),
-                             column,
-                             "Column must be set but is not - based on dependency of '%s' having value %s" % (','.join(dep), depval) )
-                                        
-  def _run_set_or_na_check(self, row):
-    """
-    Check that field is set or NA
-    """
-    for (column, content) in row.iteritems():
-      if MUSTVALORNA.get(column, False) == True:
-        if content == "":
-          self.log(row.get('Variable Name'),
-                   column,
-              "Column must be set to value or na")
-        
-        
-  def _run_not_set_check(self, row):
-    """
-    Check that a column is not set
-    """
-    for (column, content) in row.iteritems():
-      if MUSTNOTSET.get(column, False) == True:
-        if content != "":
-          self.log(row.get('Variable Name'),
-                   column,
-              "Column is set when it shouldn't be")
-                
-  def _run_check_coding_columns(self, row):
+    if self.terminology is None:
+      return
+    for (term, code, column) in self.plan.coded:
+      if row[term] in ["", "NA", "na"] or row[code] in ["", "NA", "na"]:
+        continue
+      assigned = self.terminology.code(row[term])
+      if assigned is not None:
+        if assigned != row[code]:
+          self.log(row[self.plan.name], column,
+                   "C-code %s given for %s, but the assigned C-code is %s", row[code], row[term], assigned)
+      elif self.terminology.terms_for(row[code]):
+        self.log(row[self.plan.name], column,
+                 "C-code %s given for %s is assigned to %s", row[code], row[term],
+                 ", ".join(sorted(self.terminology.terms_for(row[code]))))
+
+  @reads(u'Variable Name', u'ISO 21090 Datatype', *[y for x in BRIDG_CLASSES for y in x])
+  def _run_check_bridg_attributes_classes(self, row):
     """
-    Check that all codable elements have been coded
+    Check that the BRIDG classes/attributes are valid values
     """
-    for (target, targetted) in MAPPING_CODES.iteritems():
-      if not row.get(target) in ["", "na"] and row.get(targetted) == "":
-        self.log(row.get('Variable Name'),
-            targetted,
-            "Expected Coding is missing")
+    if BRIDG_MODEL is None:
+      return
+    name = row[self.plan.name]
+    datatypes = []
+    for (klass, attribute, class_code, attribute_code, class_column, attribute_column,
+         class_code_column, attribute_code_column) in self.plan.bridg_classes:
+      if row[klass] in ["", "NA", "na"]:
+        continue
+      if not BRIDG_MODEL.has_class(row[klass]):
+        self.log(name, class_column, "%s is not a class of BRIDG %s", row[klass], BRIDG_VERSION)
+        continue
+      code = BRIDG_MODEL.code(row[klass])
+      if code and row[class_code] not in ["", "NA", "na", None, code]:
+        self.log(name, class_code_column, "C-code %s given for %s, but its BRIDG C-code is %s",
+                 row[class_code], row[klass], code)
+      if row[attribute] in ["", "NA", "na", None]:
+        continue
+      # attributes are given bare or qualified by their class
+      (owner, member) = row[attribute].rsplit(".", 1) if "." in row[attribute] else (row[klass], row[attribute])
+      if not BRIDG_MODEL.has_attribute(owner, member):
+        self.log(name, attribute_column, "%s is not an attribute of BRIDG class %s", member, owner)
+        continue
+      datatypes.append(BRIDG_MODEL.datatype(owner, member))
+      code = BRIDG_MODEL.code(owner, member)
+      if code and row[attribute_code] not in ["", "NA", "na", None, code]:
+        self.log(name, attribute_code_column, "C-code %s given for %s, but its BRIDG C-code is %s",
+                 row[attribute_code], row[attribute], code)
+    datatype = row[self.plan.datatype]
+    if datatype in ["", "NA", "na", None]:
+      return
+    if datatypes:
+      if datatype not in datatypes:
+        self.log(name, "ISO 21090 Datatype", "Datatype %s doesn't match the BRIDG datatype of the mapped attributes (%s)",
+                 datatype, ", ".join(sorted(set(datatypes))))
+    elif datatype not in BRIDG_MODEL.datatypes:
+      self.log(name, "ISO 21090 Datatype", "%s is not a datatype used by BRIDG %s", datatype, BRIDG_VERSION)
     
+def check_concept_sheet(args):
+  """
+  Check one concept tab of a workbook against a frozen Generic index, returning the dumped state (a pool worker)
+  """
+  (contentbook, template, sheet_name, generic_index, options) = args
+  workbook = open_workbook(contentbook)
+  checker = ContentSheetChecker(**options)
+  checker.template = template
+  checker.generic_index = generic_index
+  checker.check_sheet(sheet_name, checker.open_sheet(workbook, sheet_name))
+  return checker.dump()
+
+def check_workbook(args):
+  """
+  Check one workbook in a fresh checker, returning its dumped state (a pool worker)
+  """
+  (contentbook, options) = args
+  checker = ContentSheetChecker(**options)
+  checker.load_from_file(contentbook)
+  return checker.dump()
+
 if __name__ == "__main__":
   import optparse
   parser = optparse.OptionParser()
   parser.add_option("-p", "--path", dest="prefix", default=os.getcwd(), action="store")
+  parser.add_option("-c", "--columnar", dest="columnar", default=False, action="store_true",
+                    help="evaluate the rule tables column-wise (needs numpy)")
+  parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int", action="store",
+                    help="number of workbooks to check in parallel")
+  parser.add_option("-w", "--sheet-workers", dest="workers", default=1, type="int", action="store",
+                    help="number of concept tabs of a workbook to check in parallel")
+  parser.add_option("--profile", dest="profile", default=False, action="store_true",
+                    help="print per rule and per phase timings, and save them as JSON")
+  parser.add_option("--cache", dest="cache", default=None, action="store",
+                    help="directory caching sheet results, so unchanged sheets are not re-checked")
+  parser.add_option("-t", "--terminology", dest="terminology", default=None, action="store",
+                    help="Unique Items to code workbook to check the C-codes against")
   (opts, args) = parser.parse_args()
-  checker = ContentSheetChecker()
+  options = {'columnar' : opts.columnar, 'workers' : opts.workers}
+  if opts.cache:
+    from result_cache import DiskResultCache
+    options['cache'] = DiskResultCache(opts.cache)
+  if opts.profile:
+    options['profile'] = Profile()
+  if opts.terminology:
+    from items_to_code_parser import UniqueItemsToCodeParser
+    from terminology import TerminologyIndex
+    options['terminology'] = TerminologyIndex.from_terminology(UniqueItemsToCodeParser().load_from_file(opts.terminology))
+  checker = ContentSheetChecker(**options)
+  candidates = []
   for candidate in glob.glob(os.path.join(opts.prefix, "*.xls")) + glob.glob(os.path.join(opts.prefix, "*.xlsx")):
     if '~' in candidate:
       # skip temp files
       continue
     if candidate.endswith("Template.xls") or candidate.endswith("Template.xlsx"):
+      candidates.append(candidate)
+  if opts.jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(opts.jobs)
+    # imap keeps the report in the same order as a serial run
+    for (candidate, state) in zip(candidates, pool.imap(check_workbook, [(x, options) for x in candidates])):
+      print "Checked %s" % candidate
+      checker.merge(state)
+    pool.close()
+    pool.join()
+  else:
+    for candidate in candidates:
       print "Checking %s" % candidate
       checker.load_from_file(candidate)
   #print checker.as_dict()
   checker.report()
+  if opts.profile:
+    print checker.profile.as_table()
+    with open("Content_Template_Profile_%s.json" % time.strftime("%Y-%m-%d"), "w") as profile_json:
+      profile_json.write(checker.profile.as_json())
         
     
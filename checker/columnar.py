@@ -0,0 +1,71 @@
+"""
+Column-wise storage of a sheet's content rows, for evaluating the
+compiled rule tables as whole-column mask operations
+"""
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def available():
+  """
+  Is the columnar engine usable (numpy is optional)
+  """
+  return numpy is not None
+
+class ColumnTable(object):
+  """
+  The padded content rows of a sheet as an object array, one column per
+  layout column, with lazily built 'blank' and 'equals value' masks
+  """
+
+  def __init__(self, rows, width):
+    self.width = width
+    self.length = len(rows)
+    self.values = numpy.empty((self.length, width + 1), dtype=object)
+    for (position, row) in enumerate(rows):
+      self.values[position] = row
+    self._masks = {}
+
+  def column(self, idx):
+    """
+    The values in a column
+    """
+    return self.values[:, idx]
+
+  def equals(self, idx, value):
+    """
+    Mask of the rows where a column holds the value
+    """
+    key = (idx, value)
+    if key not in self._masks:
+      self._masks[key] = self.column(idx) == value
+    return self._masks[key]
+
+  def blank(self, idx):
+    """
+    Mask of the rows where a column is blank (a missing column is never blank)
+    """
+    return self.equals(idx, u"")
+
+  def is_na(self, idx):
+    """
+    Mask of the rows where a column is set to NA
+    """
+    return self.equals(idx, u"NA") | self.equals(idx, u"na")
+
+  def every(self, masks):
+    """
+    Mask of the rows where all of the masks hold
+    """
+    combined = numpy.ones(self.length, dtype=bool)
+    for mask in masks:
+      combined &= mask
+    return combined
+
+  def positions(self, mask):
+    """
+    Row positions at which a mask holds
+    """
+    return mask.nonzero()[0]
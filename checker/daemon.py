@@ -0,0 +1,135 @@
+"""
+A long running checker, serving check jobs over a Unix socket.
+
+Imports, rule lists and compiled rule plans are set up once, so editor
+and pre-commit integrations only pay for the check itself.  A client
+sends one JSON job per line, either {"path": ...} or {"name": ...,
+"data": <base64 workbook>}, with an optional "id".  The daemon answers
+each job with its findings as JSON lines (the dicts of
+ContentSheetChecker.as_dict) followed by a status line:
+{"id": ..., "status": "ok", "findings": n, "seconds": s}, or a status of
+"error" with a message.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import signal
+import socket
+import SocketServer
+from StringIO import StringIO
+
+from check_content_sheet import ContentSheetChecker, COLUMNS, compile_rules
+
+class CheckHandler(SocketServer.StreamRequestHandler):
+  """
+  Runs the jobs sent over a connection, in order
+  """
+
+  def handle(self):
+    checker = self.server.checker
+    for line in iter(self.rfile.readline, ''):
+      if not line.strip():
+        continue
+      started = time.time()
+      status = {'id' : None, 'status' : 'ok'}
+      try:
+        job = json.loads(line)
+        status['id'] = job.get('id')
+        if job.get('path'):
+          if not os.path.isfile(job['path']):
+            raise IOError("No such template %s" % job['path'])
+          (loaded, name) = (checker.load_from_file(job['path']), job['path'])
+        elif job.get('data'):
+          name = job.get('name', 'upload.xlsx')
+          loaded = checker.load_workbook(StringIO(base64.b64decode(job['data'])), name)
+        else:
+          raise ValueError("A job needs a path or data")
+        if not loaded:
+          raise IOError("Couldn't open %s, %s" % (name, checker.failures[name]))
+        for finding in checker.as_dict():
+          self.wfile.write(json.dumps(finding) + "\n")
+        status['findings'] = len(checker.findings)
+      except Exception, e:
+        status.update({'status' : 'error', 'message' : "%s: %s" % (e.__class__.__name__, e)})
+      finally:
+        # the next job starts from a clean checker
+        checker.reset()
+      status['seconds'] = time.time() - started
+      self.wfile.write(json.dumps(status) + "\n")
+      self.wfile.flush()
+
+class CheckServer(SocketServer.UnixStreamServer):
+  """
+  Serves check jobs from one warmed up checker, a connection at a time
+  """
+
+  def __init__(self, socket_path, **options):
+    if os.path.exists(socket_path):
+      # left behind by a daemon that didn't shut down cleanly
+      os.remove(socket_path)
+    self.socket_path = socket_path
+    self.checker = ContentSheetChecker(**options)
+    for columns in COLUMNS.itervalues():
+      compile_rules(columns)
+    SocketServer.UnixStreamServer.__init__(self, socket_path, CheckHandler)
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    if os.path.exists(self.socket_path):
+      os.remove(self.socket_path)
+
+def check(socket_path, jobs):
+  """
+  Send jobs to a running daemon, yielding the finding and status dicts it returns
+  """
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.connect(socket_path)
+  try:
+    replies = client.makefile('r')
+    for job in jobs:
+      client.sendall(json.dumps(job) + "\n")
+      for line in iter(replies.readline, ''):
+        reply = json.loads(line)
+        yield reply
+        if 'status' in reply:
+          break
+  finally:
+    client.close()
+
+if __name__ == "__main__":
+  import optparse
+  parser = optparse.OptionParser(usage="%prog [options] [template ...]")
+  parser.add_option("-S", "--socket", dest="socket", default="/tmp/share_checker.sock", action="store",
+                    help="path of the Unix socket")
+  parser.add_option("--cache", dest="cache", default=None, action="store",
+                    help="directory caching sheet results, so unchanged sheets are not re-checked")
+  (opts, args) = parser.parse_args()
+  if args:
+    # as a client: check the templates and exit non-zero if any have findings
+    found = 0
+    for reply in check(opts.socket, [{'id' : x, 'path' : os.path.abspath(x)} for x in args]):
+      if 'status' not in reply:
+        print "%(template)s|%(sheet)s|%(field)s|%(column)s|%(message)s" % reply
+      elif reply['status'] == 'ok':
+        found += reply['findings']
+      else:
+        print >> sys.stderr, "Failed to check %s: %s" % (reply['id'], reply['message'])
+        found += 1
+    sys.exit(1 if found else 0)
+  options = {}
+  if opts.cache:
+    from result_cache import DiskResultCache
+    options['cache'] = DiskResultCache(opts.cache)
+  server = CheckServer(opts.socket, **options)
+  print "Checking templates sent to %s" % opts.socket
+  # a terminated daemon still removes its socket
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
@@ -0,0 +1,135 @@
+"""
+Compact storage for the findings of a checker run
+"""
+
+from array import array
+
+ERROR = "error"
+WARNING = "warning"
+INFO = "info"
+
+# severity of findings by the start of their message, anything else is an error
+SEVERITIES = [("Sheet has been marked as Work in Progress", INFO),
+              ("Column is set", WARNING),
+              ("Should not be set", WARNING),
+              ("No BRIDG Mapping", WARNING),
+              ("CDASH Datatype is Enumerated", WARNING)]
+
+def severity(message):
+  """
+  The severity of a finding from its message
+  """
+  for (start, level) in SEVERITIES:
+    if message.startswith(start):
+      return level
+  return ERROR
+
+class FindingStore(object):
+  """
+  Findings held as parallel arrays of ids into one table of interned
+  strings (templates, sheets, fields, columns and message templates).
+  Message arguments are kept aside and only formatted when rendered.
+  """
+
+  def __init__(self):
+    self.strings = []
+    self._ids = {}
+    self._templates = array('l')
+    self._sheets = array('l')
+    self._fields = array('l')
+    self._columns = array('l')
+    self._messages = array('l')
+    # message arguments, by position - most messages have none
+    self._args = {}
+
+  def __len__(self):
+    return len(self._messages)
+
+  def intern(self, value):
+    """
+    Id of a string in the table, adding it if new
+    """
+    try:
+      return self._ids[value]
+    except KeyError:
+      self._ids[value] = len(self.strings)
+      self.strings.append(value)
+      return self._ids[value]
+
+  def add(self, template, sheet, field, column, message, args=()):
+    """
+    Record a finding; message is a template for the args, if any
+    """
+    if args:
+      self._args[len(self._messages)] = tuple(args)
+    self._templates.append(self.intern(template))
+    self._sheets.append(self.intern(sheet))
+    self._fields.append(self.intern(field))
+    self._columns.append(self.intern(column))
+    self._messages.append(self.intern(message))
+
+  def raw(self, template=None):
+    """
+    Iterate over findings as (template, sheet, field, column, message template, args),
+    optionally for a single template
+    """
+    strings = self.strings
+    if template is None:
+      positions = xrange(len(self._messages))
+    elif template in self._ids:
+      wanted = self._ids[template]
+      positions = [x for (x, y) in enumerate(self._templates) if y == wanted]
+    else:
+      positions = []
+    for position in positions:
+      yield (strings[self._templates[position]],
+             strings[self._sheets[position]],
+             strings[self._fields[position]],
+             strings[self._columns[position]],
+             strings[self._messages[position]],
+             self._args.get(position, ()))
+
+  def __iter__(self):
+    """
+    Iterate over findings as (template, sheet, field, column, message)
+    """
+    for (template, sheet, field, column, message, args) in self.raw():
+      yield (template, sheet, field, column, render(message, args))
+
+  def templates(self):
+    """
+    The templates with findings, in the order they were first found
+    """
+    return [self.strings[x] for x in sorted(set(self._templates))]
+
+  def issues(self, template):
+    """
+    The findings for one template, as [sheet, field, column, message] lists
+    """
+    return [[sheet, field, column, render(message, args)]
+            for (_, sheet, field, column, message, args) in self.raw(template)]
+
+  def dump(self):
+    """
+    Serialise the store (for worker processes), keeping it interned
+    """
+    return {'strings' : self.strings,
+            'findings' : zip(self._templates, self._sheets, self._fields, self._columns, self._messages),
+            'args' : self._args.items()}
+
+  def merge(self, dumped):
+    """
+    Add the findings of a dumped store
+    """
+    args = dict(dumped['args'])
+    strings = dumped['strings']
+    for (position, finding) in enumerate(dumped['findings']):
+      self.add(*[strings[x] for x in finding] + [args.get(position, ())])
+
+def render(message, args):
+  """
+  Format a message template with its arguments
+  """
+  if args:
+    return message % tuple(args)
+  return message
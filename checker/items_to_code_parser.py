@@ -1,24 +1,8 @@
 import xlrd
-import openpyxl
 import logging
 
-def si(content):
-  """
-  If it gets a None, return '', else return cleaned string
-  """
-  import types
-  if isinstance(content, openpyxl.cell.Cell):
-    if isinstance(content.value, types.NoneType):
-      return unicode('')
-    else:
-      return unicode(content.value).strip()
-  elif isinstance(content, xlrd.sheet.Cell):
-    if content.ctype == xlrd.sheet.XL_CELL_EMPTY:
-      return unicode('')
-    else:
-      return unicode(content.value).strip()
-  return unicode(content).strip()
-    
+from normalize import normalize
+
 class UniqueItemsToCodeParser(object):
   
   def __init__(self, codes=[]):
@@ -26,17 +10,25 @@ class UniqueItemsToCodeParser(object):
     self.codes = dict([[x.get('name'), x] for x in codes])
     
   def load_from_mem(self, mem_obj):
+    return self.load_contents(mem_obj.file.read())
+
+  def load_from_file(self, path):
+    with open(path, 'rb') as terminology_sheet:
+      return self.load_contents(terminology_sheet.read())
+
+  def load_contents(self, contents):
     codes = {}
     try:
-      workbook = xlrd.open_workbook(file_contents=mem_obj.file.read())
+      workbook = xlrd.open_workbook(file_contents=contents)
     except Exception, e:
       logging.exception("Couldn't open terminology sheet: %s" % e)
       return {}
     for sheet_name in workbook.sheet_names():
       sheet = workbook.sheet_by_name(sheet_name)
-      cols = [si(x) for x in sheet.row_values(0)]
+      # row_values gives raw values
+      cols = [normalize(x) for x in sheet.row_values(0)]
       for row in range(1, sheet.nrows):
-        content = dict(zip(cols, [si(x) for x in sheet.row_values(row)]))
+        content = dict(zip(cols, [normalize(x) for x in sheet.row_values(row)]))
         code = codes.setdefault(content['Field'], {})
         code['name'] = content['Field']
         if 'Context' in content:
@@ -1,53 +1,565 @@
 import json 
+import zlib
+import time
+import hashlib
 from google.appengine.ext import db
+from google.appengine.api import memcache
+
+from findings import FindingStore, severity, ERROR, WARNING, INFO
+from terminology import TerminologyIndex
+from result_cache import MemcacheResultCache
+
+# states of a check run - runs from before background checking have none, and are done
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# how the findings of a run are stored - runs from before the blob storage have none
+STORAGE_ENTITIES = "entities"
+STORAGE_BLOB = "blob"
+# the storage new runs use
+FINDINGS_STORAGE = STORAGE_BLOB
 
 class CheckLog(db.Model):
-  opener = db.UserProperty(auto_current_user=True)
+  # only set when the run is created: the run is stored again from tasks,
+  # which have no signed in user
+  opener = db.UserProperty(auto_current_user_add=True)
   sheet = db.StringProperty(verbose_name="Content Template", required=True)
-  date = db.DateTimeProperty(verbose_name="Date Checked", auto_now=True)
+  date = db.DateTimeProperty(verbose_name="Date Checked", auto_now_add=True)
+  status = db.StringProperty(verbose_name="Status", default=STATUS_DONE)
+  finding_count = db.IntegerProperty(verbose_name="Findings")
+  error_count = db.IntegerProperty(verbose_name="Errors")
+  warning_count = db.IntegerProperty(verbose_name="Warnings")
+  info_count = db.IntegerProperty(verbose_name="Notes")
+  storage = db.StringProperty(verbose_name="Findings Storage")
+
+  @property
+  def is_done(self):
+    return self.status in (None, STATUS_DONE)
+
+  @property
+  def issues(self):
+    """
+    The findings of the run, ordered by tab and field; a blob is only
+    decoded when first asked for
+    """
+    if not hasattr(self, '_issues'):
+      if self.storage == STORAGE_BLOB:
+        self._issues = sorted(decode_findings(self, load_parts(FindingsBlob, self)[0]),
+                              key=lambda x: (x.tab, x.field))
+      else:
+        self._issues = list(self.findings.order("tab").order("field"))
+    return self._issues
+
+  def iter_issues(self, chunk=None):
+    """
+    The findings of the run for export, in chunks of a cursor query when
+    stored as entities, so no more than a chunk is held at once
+    """
+    if self.storage == STORAGE_BLOB or hasattr(self, '_issues'):
+      for issue in self.issues:
+        yield issue
+      return
+    query = self.findings.order("tab").order("field")
+    while True:
+      issues = query.fetch(chunk or EXPORT_CHUNK)
+      for issue in issues:
+        yield issue
+      if len(issues) < (chunk or EXPORT_CHUNK):
+        break
+      query.with_cursor(query.cursor())
+
+  @property
+  def issue_count(self):
+    if self.finding_count is not None:
+      return self.finding_count
+    return self.findings.count()
+
+  def count_findings(self, issues):
+    """
+    Keep the number of findings, and of each severity, on the run
+    """
+    counts = {ERROR : 0, WARNING : 0, INFO : 0}
+    for issue in issues:
+      counts[severity(issue.get('message'))] += 1
+    self.finding_count = len(issues)
+    self.error_count = counts[ERROR]
+    self.warning_count = counts[WARNING]
+    self.info_count = counts[INFO]
+
+# findings fetched per query when exporting a run stored as entities
+EXPORT_CHUNK = 500
+
+# large values are kept in parts below the entity size limit
+PART_SIZE = 900 * 1024
+
+class TemplateUpload(db.Model):
+  """
+  A part of an uploaded template waiting to be checked, a child of its CheckLog
+  """
+  part = db.IntegerProperty(required=True)
+  content = db.BlobProperty(required=True)
+
+class FindingsBlob(db.Model):
+  """
+  A part of the compressed findings of a run, a child of its CheckLog
+  """
+  part = db.IntegerProperty(required=True)
+  content = db.BlobProperty(required=True)
+
+def store_parts(kind, checklog, content):
+  """
+  Store a value as parts of a kind, children of the CheckLog
+  """
+  db.put([kind(parent=checklog, part=idx, content=db.Blob(content[x:x + PART_SIZE]))
+          for (idx, x) in enumerate(range(0, len(content), PART_SIZE))])
+
+def load_parts(kind, checklog):
+  """
+  A value stored in parts of a kind, and the parts holding it
+  """
+  parts = sorted(kind.all().ancestor(checklog), key=lambda x: x.part)
+  return ("".join([x.content for x in parts]), parts)
+
+def store_upload(checklog, content):
+  """
+  Keep the bytes of an upload for the background check
+  """
+  store_parts(TemplateUpload, checklog, content)
+
+def load_upload(checklog):
+  """
+  The bytes of an upload, and the parts holding them
+  """
+  return load_parts(TemplateUpload, checklog)
 
 class FindingCategory(db.Model):
   name = db.StringProperty(verbose_name="Category Name")
         
-class ConsistencyFinding(db.Model):
-  checkrun   = db.ReferenceProperty(CheckLog, collection_name="findings")
-  template   = db.StringProperty(verbose_name="Content Template Name", required=True)
-  tab        = db.StringProperty(verbose_name="Content Sheet Tab", required=True)
-  field      = db.StringProperty(verbose_name="Content Sheet Element", required=True)
-  column     = db.StringProperty(verbose_name="Column", required=True)
-  message    = db.StringProperty(verbose_name="Issue Description", required=True)
-  categories = db.ListProperty(db.Key)
-  
-  def as_dict(self):
-    return {'owner' : self.checkrun.opener.email(),
-            'date' : self.checkrun.date.isoformat(),
+class FindingExport(object):
+  """
+  The export forms of a finding, whichever way it is stored.  Exports of a
+  whole run pass its CheckLog in, so it isn't fetched again for each finding
+  """
+
+  def as_dict(self, checkrun=None):
+    checkrun = checkrun or self.checkrun
+    return {'owner' : checkrun.opener.email(),
+            'date' : checkrun.date.isoformat(),
             'template' : self.template,
             'sheet' : self.tab,
             'field' : self.field,
             'column' : self.column,
             'message' : self.message}
   
-  def as_list(self):
+  def as_list(self, checkrun=None):
+    checkrun = checkrun or self.checkrun
     if self.field.startswith('-'):
       field = "'%s" % self.field
     else:
       field = self.field
-    return [self.checkrun.opener.email(),
-            self.checkrun.date.strftime("%Y-%b-%d %H:%M"),
+    return [checkrun.opener.email(),
+            checkrun.date.strftime("%Y-%b-%d %H:%M"),
             self.template,
             self.tab,
             field,
             self.column,
             '"%s"' % self.message]
 
+class ConsistencyFinding(FindingExport, db.Model):
+  checkrun   = db.ReferenceProperty(CheckLog, collection_name="findings")
+  template   = db.StringProperty(verbose_name="Content Template Name", required=True)
+  tab        = db.StringProperty(verbose_name="Content Sheet Tab", required=True)
+  field      = db.StringProperty(verbose_name="Content Sheet Element", required=True)
+  column     = db.StringProperty(verbose_name="Column", required=True)
+  message    = db.StringProperty(verbose_name="Issue Description", required=True)
+  categories = db.ListProperty(db.Key)
+
+class StoredFinding(FindingExport):
+  """
+  A finding decoded from the blob of its run
+  """
+
+  def __init__(self, checkrun, template, tab, field, column, message):
+    self.checkrun = checkrun
+    self.template = template
+    self.tab = tab
+    self.field = field
+    self.column = column
+    self.message = message
+
+def encode_findings(issues):
+  """
+  The issues of a check as a zlib compressed blob, each string stored once
+  """
+  store = FindingStore()
+  for issue in issues:
+    store.add(issue.get('template'), issue.get('sheet'), issue.get('field'),
+              issue.get('column'), issue.get('message'))
+  dumped = store.dump()
+  return zlib.compress(json.dumps({'strings' : dumped['strings'], 'findings' : dumped['findings']}))
+
+def decode_findings(checklog, blob):
+  """
+  The StoredFindings of a run from its blob
+  """
+  if not blob:
+    return []
+  dumped = json.loads(zlib.decompress(blob))
+  strings = dumped['strings']
+  return [StoredFinding(checklog, *[strings[x] for x in finding]) for finding in dumped['findings']]
+
+def record_findings(checklog, issues, storage=None):
+  """
+  Store the issues of a check (as from ContentSheetChecker.as_dict) against
+  its CheckLog, as one blob or an entity per finding, with their counts
+  """
+  checklog.storage = storage or FINDINGS_STORAGE
+  checklog.count_findings(issues)
+  if not issues:
+    checklog.put()
+    return
+  if checklog.storage == STORAGE_BLOB:
+    store_parts(FindingsBlob, checklog, encode_findings(issues))
+    checklog.put()
+    return
+  findings = []
+  for issue in issues:
+    findings.append(ConsistencyFinding(checkrun=checklog,
+                                       template=issue.get('template'),
+                                       tab=issue.get('sheet'),
+                                       field=issue.get('field'),
+                                       column=issue.get('column'),
+                                       message=issue.get('message')))
+  # batch put
+  db.put(findings)
+  checklog.put()
+
+def clear_findings(checklog):
+  """
+  Remove the stored findings of a run, however they are stored
+  """
+  db.delete(ConsistencyFinding.all(keys_only=True).filter("checkrun =", checklog))
+  db.delete(FindingsBlob.all(keys_only=True).ancestor(checklog))
+
+def migrate_findings(checklog):
+  """
+  Move a run's findings from an entity each to a blob, counting them
+  """
+  if checklog.storage == STORAGE_BLOB:
+    return
+  entities = list(checklog.findings)
+  issues = [{'template' : x.template, 'sheet' : x.tab, 'field' : x.field, 'column' : x.column, 'message' : x.message}
+            for x in entities]
+  if issues:
+    store_parts(FindingsBlob, checklog, encode_findings(issues))
+  checklog.storage = STORAGE_BLOB
+  checklog.count_findings(issues)
+  checklog.put()
+  db.delete(entities)
+
+# entities per batch get or put
+BATCH_SIZE = 500
+
+def chunked(items, size=BATCH_SIZE):
+  """
+  A list in chunks of at most size items
+  """
+  return [items[x:x + size] for x in range(0, len(items), size)]
+
+def term_key_name(name):
+  """
+  The key name of a term's CodedTerminology, so terms are fetched by key
+  rather than queried by name
+  """
+  return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+# codings of a term, by its code
+CODING_TODO = "TODO"
+CODING_NA = "NA"
+CODING_CODED = "CODED"
+
+def coding_status(code):
+  if code in [None, "", "CNEW"]:
+    return CODING_TODO
+  if code in ["N/A", "NA"]:
+    return CODING_NA
+  return CODING_CODED
+
 class CodedTerminology(db.Model):
   name = db.StringProperty(verbose_name="Term to be coded", required=True)
   code = db.StringProperty(verbose_name="Assigned C-code")  
   terminology_type = db.StringProperty(verbose_name="Terminology Context")
   #contained_in = db.ListProperty(db.StringProperty)
+  # the name in lower case, for prefix searches
+  name_lower = db.ComputedProperty(lambda self: self.name.lower())
+  # so the TODO and NA filters are an equality rather than an IN
+  coding_status = db.ComputedProperty(lambda self: coding_status(self.code))
   
   def is_coded(self):
     return self.code not in [None, "CNEW"]
   
   def as_dict(self):
-    return {'name' : self.name, 'code' : self.code, 'terminology_type' : self.terminology_type}
\ No newline at end of file
+    return {'name' : self.name, 'code' : self.code, 'terminology_type' : self.terminology_type}
+
+  @classmethod
+  def get_terms(cls, names):
+    """
+    The CodedTerminology of each name (None where there is none), in chunked batch gets
+    """
+    terms = {}
+    for chunk in chunked(names):
+      terms.update(zip(chunk, cls.get_by_key_name([term_key_name(x) for x in chunk])))
+    return terms
+
+def put_in_batches(entities):
+  """
+  Put entities in chunks, all the puts in flight at once
+  """
+  for rpc in [db.put_async(x) for x in chunked(entities)]:
+    rpc.get_result()
+
+def merge_terminology(terminology):
+  """
+  Add or update terms (as from UniqueItemsToCodeParser), writing only the
+  ones that change; returns the number written
+  """
+  existing = CodedTerminology.get_terms(terminology.keys())
+  to_merge = []
+  for (name, properties) in terminology.iteritems():
+    code = properties.get('code', "")
+    term_type = properties.get('terminology_type', "")
+    term = existing.get(name)
+    if term is None:
+      to_merge.append(CodedTerminology(key_name=term_key_name(name), name=name,
+                                       code=code, terminology_type=term_type))
+    elif term.code != code or term.terminology_type != term_type:
+      term.code = code
+      term.terminology_type = term_type
+      to_merge.append(term)
+  put_in_batches(to_merge)
+  if to_merge:
+    bump_terminology_version()
+  return len(to_merge)
+
+def rekey_terminology(terms):
+  """
+  Move terms stored under ids to their key names, where not already there,
+  and put the others again so their search properties are indexed
+  """
+  unkeyed = [x for x in terms if x.key().name() is None]
+  existing = CodedTerminology.get_terms([x.name for x in unkeyed])
+  put_in_batches([CodedTerminology(key_name=term_key_name(x.name), name=x.name, code=x.code,
+                                   terminology_type=x.terminology_type)
+                  for x in unkeyed if existing.get(x.name) is None] +
+                 [x for x in terms if x.key().name() is not None])
+  db.delete(unkeyed)
+  if unkeyed:
+    # cached views link to the terms by key
+    bump_terminology_version()
+
+# terms listed per page of the terminology browser
+TERMS_PAGE_SIZE = 50
+# the contexts the terminology browser filters on, as query filters
+TERM_FILTERS = {'BRIDG' : ("terminology_type =", "BRIDG"),
+                'VAR' : ("terminology_type =", "VAR"),
+                'TODO' : ("coding_status =", CODING_TODO),
+                'NA' : ("coding_status =", CODING_NA)}
+
+def search_terminology(prefix=None, context=None, cursor=None, limit=TERMS_PAGE_SIZE):
+  """
+  A page of terms by name, those starting with prefix (in any case) and
+  in a TERM_FILTERS context; returns the terms and the next page's cursor
+  """
+  query = CodedTerminology.all()
+  if context in TERM_FILTERS:
+    query.filter(*TERM_FILTERS[context])
+  prefix = (prefix or u"").strip().lower()
+  if prefix:
+    query.filter("name_lower >=", prefix).filter("name_lower <", prefix + u"\ufffd")
+  query.order("name_lower")
+  if cursor:
+    query.with_cursor(cursor)
+  terms = query.fetch(limit)
+  if len(terms) == limit:
+    return (terms, query.cursor())
+  return (terms, None)
+
+# how long a cached view of the terminology is kept, it is dropped sooner by any change to the terms
+TERMS_CACHE_TTL = 60 * 60
+# the queries behind a view are eventually consistent, so for this long after
+# a change to the terms a view may miss it and is only kept briefly
+TERMS_SETTLE_TIME = 60
+TERMS_UNSETTLED_CACHE_TTL = 10
+
+def terminology_view(prefix=None, context=None, cursor=None):
+  """
+  A page of search_terminology as {'terms' : [dicts, with their key], 'cursor' : ...},
+  cached under the terminology version so a change to any term misses it
+  """
+  if memcache.get("bumped", namespace="terminology") is None:
+    views = MemcacheResultCache(namespace="terminology_views", ttl=TERMS_CACHE_TTL)
+  else:
+    views = MemcacheResultCache(namespace="terminology_views", ttl=TERMS_UNSETTLED_CACHE_TTL)
+  key = hashlib.sha1(json.dumps([terminology_version(), usage_generation(),
+                                  prefix or u"", context or u"", cursor or u""])).hexdigest()
+  view = views.get(key)
+  if view is None:
+    (terms, cursor) = search_terminology(prefix, context, cursor)
+    usage = term_usage([x.name for x in terms])
+    view = {'terms' : [dict(x.as_dict(), key=str(x.key()), contained_in=usage[x.name]) for x in terms],
+            'cursor' : cursor}
+    views.put(key, view)
+  return view
+
+# shards of each term's usage, the templates using it are spread over them
+USAGE_SHARDS = 8
+
+class TermUsage(db.Model):
+  """
+  The templates (and their sheets) using a term, for the templates in one shard
+  """
+  term = db.StringProperty(required=True)
+  templates = db.StringListProperty(indexed=False)
+  sheets = db.StringListProperty(indexed=False)
+
+class TemplateTerms(db.Model):
+  """
+  The terms a template used when last checked, so terms it drops lose its usage
+  """
+  terms = db.TextProperty()
+
+def usage_shard(template):
+  return int(hashlib.sha1(template.encode('utf-8')).hexdigest(), 16) % USAGE_SHARDS
+
+def usage_key_name(name, shard):
+  return "%s-%s" % (term_key_name(name), shard)
+
+def usage_generation():
+  """
+  Moved on whenever the usage of a term changes, so cached views showing it miss
+  """
+  generation = memcache.get("usage", namespace="terminology")
+  if generation is None:
+    # a time, so a generation lost from memcache isn't reused
+    generation = int(time.time())
+    memcache.add("usage", generation, namespace="terminology")
+  return generation
+
+def get_in_batches(kind, key_names):
+  """
+  The entities of key names (None where there is none), in chunked batch gets
+  """
+  entities = []
+  for chunk in chunked(key_names):
+    entities.extend(kind.get_by_key_name(chunk))
+  return entities
+
+def usage_entries(entity, template, sheets):
+  """
+  The (template, sheet) entries of a TermUsage once a template's are replaced with sheets
+  """
+  return sorted([x for x in zip(entity.templates, entity.sheets) if x[0] != template] +
+                [(template, x) for x in set(sheets)])
+
+def update_term_usage(key_name, name, template, sheets):
+  """
+  Replace a template's entries in one TermUsage, in a transaction as the
+  shard is shared with other templates; True if it was written
+  """
+  def update():
+    entity = TermUsage.get_by_key_name(key_name) or TermUsage(key_name=key_name, term=name)
+    entries = usage_entries(entity, template, sheets)
+    if entries == zip(entity.templates, entity.sheets):
+      return False
+    entity.templates = [x[0] for x in entries]
+    entity.sheets = [x[1] for x in entries]
+    entity.put()
+    return True
+  return db.run_in_transaction(update)
+
+def record_term_usage(template, usage):
+  """
+  Replace a template's entries in the term usage index with usage (as
+  from ContentSheetChecker.template_usage), writing only the shards that
+  change; returns the number written
+  """
+  stamp = TemplateTerms.get_by_key_name(term_key_name(template))
+  previous = set(json.loads(stamp.terms)) if stamp is not None else set()
+  names = sorted(previous | set(usage))
+  # every entry of a template is in the same shard of each term
+  shard = usage_shard(template)
+  changed = 0
+  # a batch get finds the shards to change, each is then updated on its own
+  for (name, entity) in zip(names, get_in_batches(TermUsage, [usage_key_name(x, shard) for x in names])):
+    sheets = usage.get(name, [])
+    if entity is not None and usage_entries(entity, template, sheets) == zip(entity.templates, entity.sheets):
+      continue
+    if entity is None and not sheets:
+      continue
+    if update_term_usage(usage_key_name(name, shard), name, template, sheets):
+      changed += 1
+  if previous != set(usage):
+    TemplateTerms(key_name=term_key_name(template), terms=db.Text(json.dumps(sorted(usage)))).put()
+  if changed:
+    memcache.incr("usage", namespace="terminology", initial_value=int(time.time()))
+  return changed
+
+def term_usage(names):
+  """
+  The templates using each term, as "template (sheet, ...)" strings
+  """
+  usage = dict((x, {}) for x in names)
+  keys = [(x, usage_key_name(x, y)) for x in names for y in range(USAGE_SHARDS)]
+  for ((name, _), entity) in zip(keys, get_in_batches(TermUsage, [x[1] for x in keys])):
+    if entity is not None:
+      for (template, sheet) in zip(entity.templates, entity.sheets):
+        usage[name].setdefault(template, []).append(sheet)
+  return dict((name, ["%s (%s)" % (x, ", ".join(y)) for (x, y) in sorted(templates.iteritems())])
+              for (name, templates) in usage.iteritems())
+
+# key name of the one TerminologyVersion
+TERMINOLOGY_VERSION = "current"
+
+class TerminologyVersion(db.Model):
+  """
+  Moved on whenever a term is changed, so snapshots of the terminology know they are stale
+  """
+  version = db.IntegerProperty(default=0)
+
+def terminology_version():
+  """
+  The version of the terminology, from memcache where it is mirrored so
+  most reads don't touch the datastore
+  """
+  version = memcache.get(TERMINOLOGY_VERSION, namespace="terminology")
+  if version is None:
+    stamp = TerminologyVersion.get_by_key_name(TERMINOLOGY_VERSION)
+    version = 0 if stamp is None else stamp.version
+    # add, so a bump in the meantime isn't overwritten
+    memcache.add(TERMINOLOGY_VERSION, version, namespace="terminology")
+  return version
+
+def bump_terminology_version():
+  """
+  Move the terminology version on, dropping every snapshot and cached view of the terms
+  """
+  def bump():
+    stamp = TerminologyVersion.get_by_key_name(TERMINOLOGY_VERSION) or TerminologyVersion(key_name=TERMINOLOGY_VERSION)
+    stamp.version += 1
+    stamp.put()
+    return stamp.version
+  version = db.run_in_transaction(bump)
+  memcache.set(TERMINOLOGY_VERSION, version, namespace="terminology")
+  # views built until the change has settled into the indexes aren't kept for long
+  memcache.set("bumped", version, time=TERMS_SETTLE_TIME, namespace="terminology")
+  return version
+
+def terminology_snapshot(version=None):
+  """
+  A TerminologyIndex of all the terms, stamped with the terminology version
+  """
+  if version is None:
+    version = terminology_version()
+  return TerminologyIndex([(x.name, x.code) for x in CodedTerminology.all().run(batch_size=BATCH_SIZE)], version)
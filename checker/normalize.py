@@ -0,0 +1,74 @@
+"""
+Normalisation of cell contents to the stripped unicode the rules compare.
+
+This runs for every cell checked, so each reader backend has its own fast
+path (raw values, openpyxl Cell and RawCell, xlrd Cell) and the highly
+repetitive values ("NA", "Y", "N", BRIDG class names, ...) are interned
+in a bounded cache rather than stripped into a new string every time.
+"""
+
+import openpyxl
+from openpyxl.reader.iter_worksheet import RawCell
+
+try:
+  import xlrd
+except ImportError:
+  xlrd = None
+
+# values longer than this are seldom repeated, so aren't worth keeping
+INTERN_LENGTH = 64
+# the cache is dropped once it holds this many values
+INTERN_SIZE = 4096
+
+_INTERNED = {}
+
+def normalize(value):
+  """
+  Normalise a raw cell value: '' for None, otherwise a stripped unicode string
+  """
+  if value is None:
+    return u''
+  if value.__class__ is unicode or value.__class__ is str:
+    try:
+      return _INTERNED[value]
+    except KeyError:
+      cleaned = unicode(value).strip()
+      if len(value) <= INTERN_LENGTH:
+        if len(_INTERNED) >= INTERN_SIZE:
+          _INTERNED.clear()
+        _INTERNED[value] = cleaned
+      return cleaned
+  return unicode(value).strip()
+
+def normalize_cell(cell):
+  """
+  Normalise an openpyxl Cell
+  """
+  return normalize(cell.value)
+
+def normalize_raw_cell(cell):
+  """
+  Normalise an openpyxl RawCell, from the optimised reader
+  """
+  return normalize(cell.internal_value)
+
+def normalize_xlrd_cell(cell):
+  """
+  Normalise an xlrd Cell
+  """
+  if cell.ctype == xlrd.XL_CELL_EMPTY:
+    return u''
+  return normalize(cell.value)
+
+# fast paths by exact type, anything else is a raw value
+NORMALIZERS = {openpyxl.cell.Cell : normalize_cell,
+               RawCell : normalize_raw_cell}
+if xlrd is not None:
+  NORMALIZERS[xlrd.sheet.Cell] = normalize_xlrd_cell
+
+def si(content):
+  """
+  If it gets a None, return '', else return cleaned string - whatever the
+  backend the content came from
+  """
+  return NORMALIZERS.get(content.__class__, normalize)(content)
@@ -0,0 +1,88 @@
+"""
+Counters and timings for checker runs, per rule and per phase
+"""
+
+import json
+import threading
+
+class Profile(object):
+  """
+  For each rule: calls, total seconds and findings produced.
+  For each phase (load, headers, log): calls and total seconds.
+  """
+
+  def __init__(self):
+    self.rules = {}
+    self.phases = {}
+    self._lock = threading.Lock()
+
+  def __getstate__(self):
+    # profiles travel to and from worker processes, the lock can't
+    return {'rules' : self.rules, 'phases' : self.phases}
+
+  def __setstate__(self, state):
+    self.__init__()
+    self.rules.update(state['rules'])
+    self.phases.update(state['phases'])
+
+  def rule(self, name, seconds, findings):
+    counters = self.rules.setdefault(name, [0, 0.0, 0])
+    counters[0] += 1
+    counters[1] += seconds
+    counters[2] += findings
+
+  def phase(self, name, seconds):
+    counters = self.phases.setdefault(name, [0, 0.0])
+    counters[0] += 1
+    counters[1] += seconds
+
+  def as_dict(self):
+    """
+    The counters, as returned by worker processes and dumped to JSON
+    """
+    return {'rules' : dict((name, {'calls' : x[0], 'seconds' : x[1], 'findings' : x[2]})
+                           for (name, x) in self.rules.iteritems()),
+            'phases' : dict((name, {'calls' : x[0], 'seconds' : x[1]})
+                            for (name, x) in self.phases.iteritems())}
+
+  def as_json(self):
+    return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+  def merge(self, profile):
+    """
+    Add in the counters of another run (a Profile or its as_dict()); safe across threads
+    """
+    if isinstance(profile, Profile):
+      profile = profile.as_dict()
+    with self._lock:
+      for (name, x) in profile['rules'].iteritems():
+        counters = self.rules.setdefault(name, [0, 0.0, 0])
+        counters[0] += x['calls']
+        counters[1] += x['seconds']
+        counters[2] += x['findings']
+      for (name, x) in profile['phases'].iteritems():
+        counters = self.phases.setdefault(name, [0, 0.0])
+        counters[0] += x['calls']
+        counters[1] += x['seconds']
+
+  def rows(self):
+    """
+    Rules and phases as (kind, name, calls, seconds, findings), slowest first
+    """
+    rows = [("rule", name, x[0], x[1], x[2]) for (name, x) in self.rules.iteritems()]
+    rows.extend([("phase", name, x[0], x[1], None) for (name, x) in self.phases.iteritems()])
+    rows.sort(key=lambda x: -x[3])
+    return rows
+
+  def as_table(self):
+    """
+    A plain text table of the counters
+    """
+    lines = ["%-6s %-40s %10s %10s %10s" % ("Kind", "Name", "Calls", "Seconds", "Findings")]
+    for (kind, name, calls, seconds, findings) in self.rows():
+      lines.append("%-6s %-40s %10d %10.3f %10s" % (kind, name, calls, seconds,
+                                                    "" if findings is None else findings))
+    return "\n".join(lines)
+
+# timings of the checks run by this instance, shown with the rules
+INSTANCE_PROFILE = Profile()
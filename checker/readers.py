@@ -0,0 +1,363 @@
+"""
+Reader backends for the sheets of a content template workbook.
+
+Each backend gives the sheet names, the leading rows of a sheet (to triage
+it) and an iterator over its rows as tuples of normalised cell values, so
+the checker runs the same way whatever the format.  XlsxReader streams the
+sheet parts straight out of the zip, so triage only parses the top of each
+sheet and no sheet is held in memory.  XlrdReader reads BIFF (.xls)
+workbooks, loading each sheet only when it is asked for.
+"""
+
+import re
+import hashlib
+import datetime
+import threading
+from StringIO import StringIO
+from zipfile import ZipFile
+from xml.etree.cElementTree import iterparse, fromstring
+
+from openpyxl.shared.ooxml import ARC_WORKBOOK, ARC_WORKBOOK_RELS, ARC_SHARED_STRINGS, ARC_STYLE, PACKAGE_XL
+from openpyxl.shared.date_time import SharedDate
+from openpyxl.reader.strings import read_string_table
+from openpyxl.reader.style import read_style_table
+from openpyxl.reader.workbook import read_excel_base_date
+
+try:
+  # BIFF (.xls) workbooks
+  import xlrd
+except ImportError:
+  xlrd = None
+
+from normalize import normalize
+
+SHEET_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DOCUMENT_RELS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+CELL = SHEET_MAIN + 'c'
+ROW = SHEET_MAIN + 'row'
+VALUE = SHEET_MAIN + 'v'
+INLINE_TEXT = '%sis/%st' % (SHEET_MAIN, SHEET_MAIN)
+DIMENSION = SHEET_MAIN + 'dimension'
+
+COORDINATE = re.compile('^([A-Z]+)([0-9]+)$')
+# cells holding a shared string, in the raw sheet XML
+SHARED_STRING_CELL = re.compile(r'<c\b[^>]*\bt="s"[^>]*>\s*<v>(\d+)</v>')
+
+# leading bytes of each format
+XLSX_MAGIC = 'PK\x03\x04'
+XLS_MAGIC = '\xd0\xcf\x11\xe0'
+
+_COLUMN_INDICES = {}
+
+def column_index(letters):
+  """
+  1-based index of a column from its letters, cached as columns are seen
+  """
+  try:
+    return _COLUMN_INDICES[letters]
+  except KeyError:
+    idx = 0
+    for letter in letters:
+      idx = idx * 26 + ord(letter) - 64
+    _COLUMN_INDICES[letters] = idx
+    return idx
+
+def is_date_format(format_code):
+  """
+  Does a number format show a date or time (as openpyxl decides it)
+  """
+  return format_code is not None and any(x in format_code for x in 'dmyhs')
+
+class RowStream(object):
+  """
+  Iterator over the rows of a sheet that can be narrowed, part way
+  through, to the positions of the columns that are read
+  """
+
+  def __init__(self, rows):
+    self.columns = None
+    self._rows = rows(self)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return self._rows.next()
+
+  def project(self, columns):
+    """
+    From the next row on, only parse the cells at these positions
+    """
+    self.columns = frozenset(columns)
+
+class SheetReader(object):
+  """
+  A workbook backend: sheet_names, and rows as tuples of normalised values
+  """
+
+  sheet_names = []
+
+  def head(self, sheet_name, rows=1):
+    """
+    The first rows of a sheet (missing rows are empty tuples), reading no further
+    """
+    raise NotImplementedError
+
+  def rows(self, sheet_name):
+    """
+    A RowStream over the rows of a sheet
+    """
+    raise NotImplementedError
+
+  def digest(self, sheet_name):
+    """
+    Digest of the content of a sheet, for caching results
+    """
+    raise NotImplementedError
+
+class XlsxReader(SheetReader):
+  """
+  Streams sheets out of an xlsx (a path or file-like object)
+  """
+
+  def __init__(self, source):
+    if isinstance(source, basestring):
+      self._path = source
+      self._data = None
+    else:
+      # each stream gets its own archive over the bytes, so sheets can be
+      # read from several threads at once
+      source.seek(0)
+      self._path = None
+      self._data = source.read()
+    archive = self._archive()
+    try:
+      valid_files = archive.namelist()
+      self._parts = self._read_parts(archive)
+      self.sheet_names = [x[0] for x in self._parts]
+      self._parts = dict(self._parts)
+      if ARC_SHARED_STRINGS in valid_files:
+        self.strings = read_string_table(archive.read(ARC_SHARED_STRINGS))
+      else:
+        self.strings = {}
+      self._date_styles = set()
+      if ARC_STYLE in valid_files:
+        self._date_styles = set(str(idx) for (idx, style) in read_style_table(archive.read(ARC_STYLE)).iteritems()
+                                if is_date_format(style.number_format.format_code))
+      self._shared_date = SharedDate(base_date=read_excel_base_date(archive.read(ARC_WORKBOOK)))
+    finally:
+      archive.close()
+
+  def _archive(self):
+    if self._path is not None:
+      return ZipFile(self._path, 'r')
+    return ZipFile(StringIO(self._data), 'r')
+
+  def _read_parts(self, archive):
+    """
+    (sheet name, part path) for each sheet, in workbook order
+    """
+    targets = {}
+    for relationship in fromstring(archive.read(ARC_WORKBOOK_RELS)).findall(PACKAGE_RELS + 'Relationship'):
+      target = relationship.get('Target')
+      if not target.startswith('/'):
+        target = '%s/%s' % (PACKAGE_XL, target)
+      targets[relationship.get('Id')] = target.lstrip('/')
+    valid_files = archive.namelist()
+    parts = []
+    for sheet in fromstring(archive.read(ARC_WORKBOOK)).find(SHEET_MAIN + 'sheets'):
+      target = targets.get(sheet.get(DOCUMENT_RELS + 'id'))
+      if target in valid_files:
+        parts.append((sheet.get('name'), target))
+    return parts
+
+  def _value(self, cell):
+    data_type = cell.get('t', 'n')
+    if data_type == 'inlineStr':
+      return cell.findtext(INLINE_TEXT)
+    value = cell.findtext(VALUE)
+    if not value:
+      # a formula without a cached value is blank, as openpyxl reads it
+      return None
+    if data_type == 's':
+      return self.strings[int(value)]
+    elif data_type == 'b':
+      # openpyxl reads booleans as their stored 1 or 0
+      return int(value)
+    elif data_type in ('str', 'e'):
+      return unicode(value)
+    elif cell.get('s') in self._date_styles:
+      return self._shared_date.from_julian(float(value))
+    try:
+      return int(value)
+    except ValueError:
+      return float(value)
+
+  def _iter_rows(self, sheet_name, max_row=None, projection=None):
+    """
+    Parse a sheet part as a stream, yielding (row number, tuple of values)
+    for each row present, padded to the sheet's dimension.  Stops parsing
+    once max_row has been read.  Cells outside the columns of a projecting
+    RowStream are skipped without being typed or converted.
+    """
+    archive = self._archive()
+    stream = archive.open(self._parts[sheet_name])
+    try:
+      (min_col, max_col) = (1, None)
+      cells = {}
+      columns = None
+      for (_event, element) in iterparse(stream):
+        tag = element.tag
+        if tag == CELL:
+          column = column_index(element.get('r').rstrip('0123456789'))
+          if columns is None or (column - min_col) in columns:
+            cells[column] = normalize(self._value(element))
+          element.clear()
+        elif tag == ROW:
+          row = int(element.get('r'))
+          width = max_col or (max(cells) if cells else 0)
+          yield (row, tuple([cells.get(x, u'') for x in xrange(min_col, width + 1)]))
+          cells = {}
+          element.clear()
+          if projection is not None:
+            columns = projection.columns
+          if max_row is not None and row >= max_row:
+            break
+        elif tag == DIMENSION:
+          bounds = [COORDINATE.match(x) for x in element.get('ref').split(':')]
+          if len(bounds) == 2 and None not in bounds:
+            (min_col, max_col) = [column_index(x.group(1)) for x in bounds]
+    finally:
+      stream.close()
+      archive.close()
+
+  def head(self, sheet_name, rows=1):
+    head = [()] * rows
+    for (row, values) in self._iter_rows(sheet_name, max_row=rows):
+      if row <= rows:
+        head[row - 1] = values
+    return head
+
+  def rows(self, sheet_name):
+    def values(projection):
+      for (row, values) in self._iter_rows(sheet_name, projection=projection):
+        yield values
+    return RowStream(values)
+
+  def digest(self, sheet_name):
+    # the sheet's XML part plus the shared strings it uses, as the part
+    # only holds indices into the workbook wide string table
+    archive = self._archive()
+    try:
+      xml_source = archive.read(self._parts[sheet_name])
+    finally:
+      archive.close()
+    digest = hashlib.sha1(xml_source)
+    for string_idx in SHARED_STRING_CELL.findall(xml_source):
+      digest.update(self.strings[int(string_idx)].encode('utf-8'))
+    return digest.hexdigest()
+
+class XlrdReader(SheetReader):
+  """
+  Reads sheets of an xls (a path or file-like object) through xlrd, each
+  sheet loaded on demand and unloaded once its rows have been read
+  """
+
+  def __init__(self, source):
+    if xlrd is None:
+      raise ValueError("Reading .xls workbooks needs xlrd")
+    if isinstance(source, basestring):
+      self._book = xlrd.open_workbook(source, on_demand=True)
+    else:
+      source.seek(0)
+      self._book = xlrd.open_workbook(file_contents=source.read(), on_demand=True)
+    self.sheet_names = self._book.sheet_names()
+    # loading a sheet moves the book's position, so one sheet at a time
+    self._lock = threading.Lock()
+
+  def _sheet(self, sheet_name):
+    with self._lock:
+      return self._book.sheet_by_name(sheet_name)
+
+  def _value(self, ctype, value):
+    # values as the xlsx reader gives them, so both normalise the same
+    if ctype == xlrd.XL_CELL_NUMBER:
+      if value == int(value):
+        return int(value)
+    elif ctype == xlrd.XL_CELL_DATE:
+      try:
+        parts = xlrd.xldate_as_tuple(value, self._book.datemode)
+      except xlrd.XLDateError:
+        # a date Excel can't show (negative, or before 1900 on a Mac) stays a number
+        return value
+      if parts[:3] == (0, 0, 0):
+        # a time of day, without a date
+        return datetime.time(*parts[3:])
+      return datetime.datetime(*parts)
+    elif ctype == xlrd.XL_CELL_BOOLEAN:
+      return int(value)
+    elif ctype == xlrd.XL_CELL_ERROR:
+      return xlrd.error_text_from_code.get(value)
+    elif ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+      return None
+    return value
+
+  def _row(self, sheet, row, columns=None):
+    types = sheet.row_types(row)
+    values = sheet.row_values(row)
+    if columns is None:
+      return tuple([normalize(self._value(x, y)) for (x, y) in zip(types, values)])
+    return tuple([normalize(self._value(types[x], values[x])) if x in columns else u''
+                  for x in xrange(len(values))])
+
+  def head(self, sheet_name, rows=1):
+    sheet = self._sheet(sheet_name)
+    try:
+      head = [self._row(sheet, x) for x in xrange(min(rows, sheet.nrows))]
+    finally:
+      with self._lock:
+        self._book.unload_sheet(sheet_name)
+    return head + [()] * (rows - len(head))
+
+  def rows(self, sheet_name):
+    def values(projection):
+      sheet = self._sheet(sheet_name)
+      try:
+        for row in xrange(sheet.nrows):
+          yield self._row(sheet, row, projection.columns)
+      finally:
+        with self._lock:
+          self._book.unload_sheet(sheet_name)
+    return RowStream(values)
+
+  def digest(self, sheet_name):
+    # a BIFF sheet isn't a separate part, so digest the values read
+    sheet = self._sheet(sheet_name)
+    digest = hashlib.sha1()
+    try:
+      for row in xrange(sheet.nrows):
+        digest.update(repr(self._row(sheet, row)))
+    finally:
+      with self._lock:
+        self._book.unload_sheet(sheet_name)
+    return digest.hexdigest()
+
+def open_workbook(source):
+  """
+  A reader over a workbook (a path or file-like object), the backend
+  chosen by the format of its content
+  """
+  if isinstance(source, basestring):
+    with open(source, 'rb') as workbook:
+      magic = workbook.read(4)
+  else:
+    source.seek(0)
+    magic = source.read(4)
+    source.seek(0)
+  if magic == XLS_MAGIC:
+    return XlrdReader(source)
+  elif magic == XLSX_MAGIC:
+    return XlsxReader(source)
+  raise ValueError("Not an xlsx or xls workbook")
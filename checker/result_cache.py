@@ -0,0 +1,82 @@
+"""
+Cache of per-sheet check results, keyed by the content of the sheet, so
+re-uploads only re-check the tabs that changed
+"""
+
+import os
+import json
+import zlib
+
+class ResultCache(object):
+  """
+  Store of sheet results (JSON-able values) by key
+  """
+
+  def get(self, key):
+    raise NotImplementedError
+
+  def put(self, key, value):
+    raise NotImplementedError
+
+class DiskResultCache(ResultCache):
+  """
+  A directory of result files, evicting the least recently used beyond max_entries
+  """
+
+  def __init__(self, path, max_entries=1000):
+    self.path = path
+    self.max_entries = max_entries
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+  def _entry(self, key):
+    return os.path.join(self.path, "%s.json" % key)
+
+  def get(self, key):
+    entry = self._entry(key)
+    try:
+      with open(entry) as cached:
+        value = json.load(cached)
+    except (IOError, ValueError):
+      return None
+    # a hit makes the entry the most recently used
+    os.utime(entry, None)
+    return value
+
+  def put(self, key, value):
+    with open(self._entry(key), 'w') as cached:
+      json.dump(value, cached)
+    entries = [os.path.join(self.path, x) for x in os.listdir(self.path) if x.endswith(".json")]
+    if len(entries) > self.max_entries:
+      entries.sort(key=os.path.getmtime)
+      for entry in entries[:len(entries) - self.max_entries]:
+        try:
+          os.remove(entry)
+        except OSError:
+          # already evicted by another process
+          pass
+
+class MemcacheResultCache(ResultCache):
+  """
+  App Engine memcache (itself size bounded and LRU), values zlib compressed
+  and, given a ttl, expiring after that many seconds
+  """
+
+  def __init__(self, namespace="sheet_results", ttl=0):
+    from google.appengine.api import memcache
+    self.memcache = memcache
+    self.namespace = namespace
+    self.ttl = ttl
+
+  def get(self, key):
+    cached = self.memcache.get(key, namespace=self.namespace)
+    if cached is None:
+      return None
+    return json.loads(zlib.decompress(cached))
+
+  def put(self, key, value):
+    try:
+      self.memcache.set(key, zlib.compress(json.dumps(value)), time=self.ttl, namespace=self.namespace)
+    except ValueError:
+      # over the memcache value size limit - just don't cache it
+      pass
@@ -0,0 +1,180 @@
+"""
+Background checking of uploaded templates.
+
+An upload is stored against a queued CheckLog and a task is added to run
+the check, so request latency doesn't depend on the size of the template.
+Tasks go to the App Engine task queue; LocalQueue runs them on a thread
+in this process, for testing (and wherever the task queue is missing).
+"""
+
+import os
+import logging
+import threading
+import Queue
+from StringIO import StringIO
+
+from check_content_sheet import ContentSheetChecker
+from result_cache import MemcacheResultCache
+from profiling import Profile, INSTANCE_PROFILE
+import model
+
+# how long a re-upload of the same bytes goes straight to the earlier check
+UPLOAD_TTL = 24 * 60 * 60
+# task handlers are served under this path
+TASK_PATH = "/tasks"
+
+def upload_index():
+  """
+  The de-duplication index, from upload digests to the CheckLog checking them
+  """
+  return MemcacheResultCache(namespace="uploads", ttl=UPLOAD_TTL)
+
+# the terminology snapshot of this instance
+_TERMINOLOGY = []
+
+def terminology_index():
+  """
+  The TerminologyIndex of this instance, snapshotted once and again only
+  when the terminology version moves on
+  """
+  version = model.terminology_version()
+  if not _TERMINOLOGY or _TERMINOLOGY[0].version != version:
+    _TERMINOLOGY[:] = [model.terminology_snapshot(version)]
+  return _TERMINOLOGY[0]
+
+def check_upload(checklog_id, digest=None):
+  """
+  Check a stored upload, recording its findings against the CheckLog
+  """
+  checklog = model.CheckLog.get_by_id(int(checklog_id))
+  if checklog is None or checklog.is_done:
+    # already checked by an earlier run of the task
+    return
+  if checklog.status == model.STATUS_RUNNING:
+    # a retry of a task that died part way, drop what it stored
+    model.clear_findings(checklog)
+  checklog.status = model.STATUS_RUNNING
+  checklog.put()
+  (content, parts) = model.load_upload(checklog)
+  profile = Profile()
+  try:
+    checker = ContentSheetChecker(cache=MemcacheResultCache(), profile=profile, terminology=terminology_index())
+    if not checker.load_workbook(StringIO(content), checklog.sheet):
+      raise IOError(checker.failures[checklog.sheet])
+    # stores the counts too, when there are no findings
+    model.record_findings(checklog, checker.as_dict())
+  except Exception, e:
+    logging.exception("Checking %s failed: %s" % (checklog.sheet, e))
+    checklog.status = model.STATUS_FAILED
+    checklog.put()
+    # a failed run isn't checked again, so its upload isn't needed either
+    model.db.delete(parts)
+    return
+  INSTANCE_PROFILE.merge(profile)
+  checklog.status = model.STATUS_DONE
+  checklog.put()
+  model.db.delete(parts)
+  try:
+    model.record_term_usage(checklog.sheet, checker.template_usage(checklog.sheet))
+  except Exception, e:
+    # the findings are stored, only the usage shown on the terminology page is behind
+    logging.exception("Recording the term usage of %s failed: %s" % (checklog.sheet, e))
+  if digest:
+    # only once the findings are stored can re-uploads be sent to them
+    upload_index().put(digest, {'checklog' : checklog.key().id(), 'issues' : checker.has_issues})
+
+# CheckLogs looked at by each migration task
+MIGRATION_BATCH = 20
+
+def migrate_findings(cursor=None):
+  """
+  Move a batch of runs over to blob storage of their findings, adding a
+  task for the next batch until all are done
+  """
+  query = model.CheckLog.all()
+  if cursor:
+    query.with_cursor(cursor)
+  checklogs = query.fetch(MIGRATION_BATCH)
+  for checklog in checklogs:
+    if checklog.is_done:
+      model.migrate_findings(checklog)
+  if len(checklogs) == MIGRATION_BATCH:
+    queue().add("migrate", cursor=query.cursor())
+
+def rekey_terminology(cursor=None):
+  """
+  Move a batch of terms over to key names, adding a task for the next
+  batch until all are done
+  """
+  query = model.CodedTerminology.all()
+  if cursor:
+    query.with_cursor(cursor)
+  terms = query.fetch(model.BATCH_SIZE)
+  model.rekey_terminology(terms)
+  if len(terms) == model.BATCH_SIZE:
+    queue().add("rekey_terminology", cursor=query.cursor())
+
+# the work behind each task name
+HANDLERS = {'check' : check_upload,
+            'migrate' : migrate_findings,
+            'rekey_terminology' : rekey_terminology}
+
+class TaskQueue(object):
+  """
+  The App Engine task queue, tasks posted to TASK_PATH/<name>
+  """
+
+  def __init__(self, queue_name="default"):
+    from google.appengine.api import taskqueue
+    self.taskqueue = taskqueue
+    self.queue_name = queue_name
+
+  def add(self, name, **params):
+    self.taskqueue.add(url="%s/%s" % (TASK_PATH, name), params=params, queue_name=self.queue_name)
+
+class LocalQueue(object):
+  """
+  An in-process stand-in for the task queue, running tasks in order on a worker thread
+  """
+
+  def __init__(self):
+    self.tasks = Queue.Queue()
+    worker = threading.Thread(target=self._work)
+    worker.daemon = True
+    worker.start()
+
+  def _work(self):
+    while True:
+      (name, params) = self.tasks.get()
+      try:
+        HANDLERS[name](**params)
+      except Exception, e:
+        logging.exception("Task %s failed: %s" % (name, e))
+      finally:
+        self.tasks.task_done()
+
+  def add(self, name, **params):
+    self.tasks.put((name, params))
+
+  def join(self):
+    """
+    Wait until every task added has run
+    """
+    self.tasks.join()
+
+_QUEUE = []
+
+def queue():
+  """
+  The queue tasks are added to: the task queue, unless SHARE_TASK_QUEUE is
+  set to local or the task queue can't be imported
+  """
+  if not _QUEUE:
+    if os.environ.get("SHARE_TASK_QUEUE") == "local":
+      _QUEUE.append(LocalQueue())
+    else:
+      try:
+        _QUEUE.append(TaskQueue())
+      except ImportError:
+        _QUEUE.append(LocalQueue())
+  return _QUEUE[0]
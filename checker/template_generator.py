@@ -0,0 +1,131 @@
+"""
+Synthetic SHARE content templates, for benchmarking the checker.
+
+A template has an Instructions tab, a Generic tab in the GENERIC layout and
+a number of concept tabs in the TEMPLATE layout.  Cells hold plausible
+values, with configurable rates of blanks, NAs and seeded errors (values
+the rules should report).
+"""
+
+import random
+
+from openpyxl.workbook import Workbook
+
+from check_content_sheet import COLUMNS, BRIDG_VERSION, MUSTVALORNA, MUSTNOTSET, MUTEX, REVERSE_DEPS
+
+# plausible values, by column - anything else gets a generated text value
+VALUES = {u'Variable Name C-Code' : [u'C25364', u'C49489', u'C25206', u'C41255'],
+          u'SDTM IG 3.1.2' : [u'Y', u'N'],
+          u'CDASH V1.1' : [u'Y', u'N'],
+          u'CDASH V1.1 Conceptual Datatype' : [u'Enumerated', u'Text', u'Integer', u'Date'],
+          u'SDTM IG 3.1.2 Datatype' : [u'Char', u'Num'],
+          u'Codelist Master' : [u'NY', u'UNIT', u'VSTESTCD', u'POSITION'],
+          u'Mapping to BRIDG Defined Class' : [u'DefinedObservation', u'DefinedActivity'],
+          u'Mapping to BRIDG Defined Class Attribute' : [u'DefinedObservation.nameCode', u'DefinedActivity.code'],
+          u'Mapping to BRIDG Performed Class' : [u'PerformedObservation', u'PerformedObservationResult'],
+          u'Mapping to BRIDG Performed Class Attribute' : [u'PerformedObservation.bodyPositionCode',
+                                                          u'PerformedObservationResult.value'],
+          u'ISO 21090 Datatype' : [u'CD', u'PQ', u'TS.DATETIME', u'ST'],
+          u'ISO 21090 Datatype Constraint' : [u'CD.CV', u'PQ.TIME', u'ST.SIMPLE'],
+          u'AsCollectedIndicator' : [u'Y', u'N'],
+          u'Observation, ObservationResult, Activity, Relationship' : [u'Observation', u'ObservationResult',
+                                                                      u'Activity'],
+          u'Boolean Mapping' : [u'Y', u'N'],
+          u'Null Flavors' : [u'NI', u'UNK']}
+
+# columns that may hold NA in place of a value
+NA_COLUMNS = set(MUSTVALORNA) | set([x for x in COLUMNS['GENERIC'] if x.endswith('C-Code')])
+
+def cell_value(column, row_idx, rates, rnd):
+  """
+  A value for a cell: blank, NA, a seeded error or a plausible value
+  """
+  roll = rnd.random()
+  if column in MUSTNOTSET:
+    # an error is a value where there should be none
+    return u'Y' if roll < rates['error'] else None
+  if roll < rates['blank']:
+    return None
+  roll -= rates['blank']
+  if column in NA_COLUMNS and roll < rates['na']:
+    return rnd.choice([u'NA', u'na'])
+  roll -= rates['na']
+  if roll < rates['error']:
+    # blanking a column that must be set is the common slip
+    return None
+  if column in VALUES:
+    return rnd.choice(VALUES[column])
+  return u'%s %d' % (column.split(' ')[0], row_idx)
+
+def fix_dependencies(values, rates, rnd):
+  """
+  Keep a row consistent with the dependencies between columns, unless an
+  error is seeded: dependent columns blank and only one of a mutex pair set
+  """
+  for (column, dependencies) in REVERSE_DEPS.iteritems():
+    for (col_dep, dep_val) in dependencies.iteritems():
+      if values.get(col_dep) == dep_val and rnd.random() >= rates['error']:
+        values[column] = None
+  for (first, second) in MUTEX:
+    if values.get(first) not in (None, u'NA', u'na') and rnd.random() >= rates['error']:
+      values[second] = u'NA'
+
+def fill_sheet(sheet, columns, variables, rates, rnd):
+  """
+  Write the header and content rows of a template sheet
+  """
+  sheet.cell(row=0, column=0).value = u'BRIDG Version'
+  sheet.cell(row=0, column=1).value = BRIDG_VERSION
+  sheet.cell(row=1, column=0).value = u'Domain'
+  sheet.cell(row=1, column=1).value = u'VS'
+  for (col_idx, column) in enumerate(columns):
+    sheet.cell(row=2, column=col_idx).value = column
+  for (row_idx, variable) in enumerate(variables):
+    values = dict((x, cell_value(x, row_idx, rates, rnd)) for x in columns)
+    values[u'Variable Name'] = variable
+    fix_dependencies(values, rates, rnd)
+    for (col_idx, column) in enumerate(columns):
+      if values[column] is not None:
+        sheet.cell(row=3 + row_idx, column=col_idx).value = values[column]
+
+def generate_template(path, concepts=3, rows=50, blank_rate=0.05, na_rate=0.1, error_rate=0.02, seed=None):
+  """
+  Write a synthetic content template to path: a Generic tab with rows
+  variables and concept tabs each using a share of them.  At error_rate a
+  concept variable is also missing from the Generic tab.
+  """
+  rnd = random.Random(seed)
+  rates = {'blank' : blank_rate, 'na' : na_rate, 'error' : error_rate}
+  workbook = Workbook()
+  instructions = workbook.get_active_sheet()
+  instructions.title = u'Instructions'
+  instructions.cell(row=0, column=0).value = u'Synthetic content template'
+  variables = [u'VAR%d' % x for x in range(rows)]
+  generic = workbook.create_sheet()
+  generic.title = u'Generic'
+  fill_sheet(generic, COLUMNS['GENERIC'], variables, rates, rnd)
+  for concept in range(concepts):
+    sheet = workbook.create_sheet()
+    sheet.title = u'Concept %d' % (concept + 1)
+    used = [x if rnd.random() >= error_rate else u'%sX' % x
+            for x in rnd.sample(variables, max(1, len(variables) / 2))]
+    fill_sheet(sheet, COLUMNS['TEMPLATE'], used, rates, rnd)
+  workbook.save(path)
+  return path
+
+if __name__ == "__main__":
+  import optparse
+  parser = optparse.OptionParser(usage="%prog [options] path")
+  parser.add_option("-n", "--concepts", dest="concepts", default=3, type="int", action="store",
+                    help="number of concept tabs")
+  parser.add_option("-r", "--rows", dest="rows", default=50, type="int", action="store",
+                    help="number of variables on the Generic tab")
+  parser.add_option("--blank-rate", dest="blank_rate", default=0.05, type="float", action="store")
+  parser.add_option("--na-rate", dest="na_rate", default=0.1, type="float", action="store")
+  parser.add_option("--error-rate", dest="error_rate", default=0.02, type="float", action="store")
+  parser.add_option("--seed", dest="seed", default=None, type="int", action="store")
+  (opts, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("a path for the template is needed")
+  print "Wrote %s" % generate_template(args[0], opts.concepts, opts.rows, opts.blank_rate,
+                                       opts.na_rate, opts.error_rate, opts.seed)
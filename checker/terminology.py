@@ -0,0 +1,58 @@
+"""
+An in memory index of the coded terminology.
+
+The C-code columns of a template are checked against the terminology for
+every mapping cell, so the terminology is snapshotted into a term to code
+map (and a code to terms reverse map) once per instance rather than being
+queried per check.  Each snapshot carries the version of the terminology
+it was taken at, so it is only taken again once the terminology changes.
+"""
+
+import hashlib
+
+# codes that don't assign a C-code to a term
+UNASSIGNED = [None, "", "CNEW", "NA", "N/A"]
+
+class TerminologyIndex(object):
+  """
+  Terms to their assigned C-codes, and C-codes to the terms assigned them
+  """
+
+  def __init__(self, terms=(), version=None):
+    self.codes = {}
+    self.terms = {}
+    for (name, code) in terms:
+      self.add(name, code)
+    # without a version (a snapshot not from the datastore) the content stands in
+    self.version = version if version is not None else self.digest()
+
+  @classmethod
+  def from_terminology(cls, terminology, version=None):
+    """
+    An index of terms as from UniqueItemsToCodeParser
+    """
+    return cls([(name, x.get('code')) for (name, x) in terminology.iteritems()], version)
+
+  def add(self, name, code):
+    if code in UNASSIGNED:
+      return
+    self.codes[name] = code
+    self.terms.setdefault(code, set()).add(name)
+
+  def code(self, name):
+    """
+    The C-code assigned to a term, None if it has none
+    """
+    return self.codes.get(name)
+
+  def terms_for(self, code):
+    """
+    The terms assigned a C-code
+    """
+    return self.terms.get(code, ())
+
+  def digest(self):
+    return hashlib.sha1(repr(sorted(self.codes.iteritems()))).hexdigest()[:12]
+
+  def __len__(self):
+    return len(self.codes)
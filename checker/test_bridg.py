@@ -0,0 +1,138 @@
+"""
+The BRIDG model index, and the class, attribute and datatype checks made with it.
+
+The model here is a fixture cut down to a few classes, with made up
+C-codes, not an extract of BRIDG.
+
+  python -m unittest discover -s checker -p "test_*.py"
+"""
+
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+import bridg
+import check_content_sheet
+from check_content_sheet import ContentSheetChecker, COLUMNS, compile_rules
+
+# Class, Superclass, Attribute, Datatype, Class C-Code, Attribute C-Code
+EXPORT = [["Activity", "", "code", "CD", "C0001", "C0002"],
+          ["PerformedObservation", "Activity", "bodyPositionCode", "CD", "C0010", "C0011"],
+          ["PerformedObservationResult", "", "value", "ANY", "C0020", "C0021"],
+          ["PerformedObservationResult", "", "valueNullFlavorReasonCode", "CD", "C0020", ""],
+          ["DefinedObservation", "", "nameCode", "CD", "C0030", "C0031"]]
+
+def fixture_model():
+  header = ["Class", "Superclass", "Attribute", "Datatype", "Class C-Code", "Attribute C-Code"]
+  return bridg.build_model([dict(zip(header, [unicode(y) for y in x])) for x in EXPORT], "test")
+
+class ModelTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix="share_bridg")
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def test_build(self):
+    model = fixture_model()
+    self.assertTrue(model.has_class(u"PerformedObservation"))
+    self.assertFalse(model.has_class(u"PerformedThing"))
+    # attributes are inherited
+    self.assertTrue(model.has_attribute(u"PerformedObservation", u"code"))
+    self.assertFalse(model.has_attribute(u"Activity", u"bodyPositionCode"))
+    self.assertEqual(model.datatype(u"PerformedObservationResult", u"value"), u"ANY")
+    self.assertEqual(model.code(u"PerformedObservation"), u"C0010")
+    self.assertEqual(model.code(u"PerformedObservation", u"bodyPositionCode"), u"C0011")
+    self.assertEqual(model.code(u"PerformedObservationResult", u"valueNullFlavorReasonCode"), None)
+    self.assertEqual(model.datatypes, frozenset([u"CD", u"ANY"]))
+
+  def test_save_and_load(self):
+    export = os.path.join(self.workdir, "export.csv")
+    with open(export, "wb") as rows:
+      writer = csv.writer(rows)
+      writer.writerow(["Class", "Superclass", "Attribute", "Datatype", "Class C-Code", "Attribute C-Code"])
+      writer.writerows(EXPORT)
+    model = bridg.build_model(bridg.read_export(export), "test")
+    path = os.path.join(self.workdir, "bridg-test.json")
+    model.save(path)
+    loaded = bridg.BridgModel.load(path)
+    self.assertEqual(loaded.dump(), fixture_model().dump())
+    self.assertEqual(bridg.load_model("0.0.0-missing"), None)
+
+class RuleTest(unittest.TestCase):
+
+  def setUp(self):
+    self.bundled = check_content_sheet.BRIDG_MODEL
+    check_content_sheet.BRIDG_MODEL = fixture_model()
+    self.checker = ContentSheetChecker()
+    self.checker.template = "BRIDG Template.xlsx"
+    self.checker.sheet = "Generic"
+    self.checker.plan = compile_rules(COLUMNS['GENERIC'])
+
+  def tearDown(self):
+    check_content_sheet.BRIDG_MODEL = self.bundled
+
+  def check(self, **values):
+    """
+    The findings of the rule for a Generic row, values given by column
+    """
+    values.setdefault(u'Variable Name', u'--POS')
+    plan = self.checker.plan
+    row = plan.pad([values.get(x, u'') for x in plan.columns])
+    self.checker.findings = check_content_sheet.FindingStore()
+    self.checker._run_check_bridg_attributes_classes(row)
+    return [(x['column'], x['message']) for x in self.checker.as_dict()]
+
+  def test_valid(self):
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Performed Class' : u'PerformedObservation',
+                                   u'Mapping to BRIDG Performed Class Attribute' : u'bodyPositionCode',
+                                   u'BRIDG Performed Class C-Code' : u'C0010',
+                                   u'BRIDG Performed Class Attribute C-Code' : u'C0011',
+                                   u'ISO 21090 Datatype' : u'CD'}), [])
+    self.assertFalse([x for x in self.checker.rule_specifications if "unavailable" in x])
+    # attributes qualified by their class, NA and blank cells
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Performed Class' : u'PerformedObservation',
+                                   u'Mapping to BRIDG Performed Class Attribute' : u'PerformedObservation.code',
+                                   u'Mapping to BRIDG Defined Class' : u'NA',
+                                   u'ISO 21090 Datatype' : u'CD'}), [])
+
+  def test_class(self):
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Defined Class' : u'DefinedThing',
+                                   u'Mapping to BRIDG Defined Class Attribute' : u'nameCode'}),
+                     [(u'Mapping to BRIDG Defined Class', u'DefinedThing is not a class of BRIDG 3.0.3')])
+
+  def test_attribute(self):
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Defined Class' : u'DefinedObservation',
+                                   u'Mapping to BRIDG Defined Class Attribute' : u'value'}),
+                     [(u'Mapping to BRIDG Defined Class Attribute',
+                       u'value is not an attribute of BRIDG class DefinedObservation')])
+
+  def test_codes(self):
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Planned Class' : u'PerformedObservationResult',
+                                   u'Mapping to BRIDG Planned Class Attribute' : u'value',
+                                   u'BRIDG Planned Class C-Code' : u'C0010',
+                                   u'BRIDG Planned Class Attribute C-Code' : u'C0020'}),
+                     [(u'BRIDG Planned Class C-Code',
+                       u'C-code C0010 given for PerformedObservationResult, but its BRIDG C-code is C0020'),
+                      (u'BRIDG Planned Class Attribute C-Code',
+                       u'C-code C0020 given for value, but its BRIDG C-code is C0021')])
+
+  def test_datatype(self):
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Performed Class' : u'PerformedObservationResult',
+                                   u'Mapping to BRIDG Performed Class Attribute' : u'value',
+                                   u'ISO 21090 Datatype' : u'PQ'}),
+                     [(u'ISO 21090 Datatype',
+                       u"Datatype PQ doesn't match the BRIDG datatype of the mapped attributes (ANY)")])
+    self.assertEqual(self.check(**{u'ISO 21090 Datatype' : u'XYZ'}),
+                     [(u'ISO 21090 Datatype', u'XYZ is not a datatype used by BRIDG 3.0.3')])
+
+  def test_no_model(self):
+    check_content_sheet.BRIDG_MODEL = None
+    self.assertEqual(self.check(**{u'Mapping to BRIDG Defined Class' : u'DefinedThing'}), [])
+    self.assertTrue([x for x in self.checker.rule_specifications if "unavailable" in x])
+
+if __name__ == "__main__":
+  unittest.main()
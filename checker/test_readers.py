@@ -0,0 +1,130 @@
+"""
+The workbook readers give the same normalised rows as openpyxl does.
+
+  python -m unittest discover -s checker -p "test_*.py"
+"""
+
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+import openpyxl
+from openpyxl.workbook import Workbook
+try:
+  import xlwt
+except ImportError:
+  xlwt = None
+
+from normalize import si
+from readers import XlsxReader, XlrdReader, open_workbook, xlrd
+from template_generator import generate_template
+
+def content(rows):
+  """
+  The rows holding a value, without trailing blank cells - the readers
+  skip empty rows and cells that openpyxl fills in
+  """
+  rows = [list(x) for x in rows]
+  for row in rows:
+    while row and row[-1] == u'':
+      row.pop()
+  return [tuple(x) for x in rows if x]
+
+def save_as_xls(path, xls_path):
+  """
+  Copy the values of an xlsx into an xls, as Excel would save it
+  """
+  workbook = xlwt.Workbook()
+  dates = xlwt.easyxf(num_format_str="yyyy-mm-dd hh:mm")
+  times = xlwt.easyxf(num_format_str="hh:mm")
+  for sheet in openpyxl.reader.excel.load_workbook(path).worksheets:
+    copy = workbook.add_sheet(sheet.title)
+    for (row_idx, row) in enumerate(sheet.rows):
+      for (col_idx, cell) in enumerate(row):
+        if cell.value is None or cell.value == '':
+          continue
+        if isinstance(cell.value, datetime.datetime):
+          copy.write(row_idx, col_idx, cell.value, dates)
+        elif isinstance(cell.value, datetime.time):
+          copy.write(row_idx, col_idx, cell.value, times)
+        else:
+          copy.write(row_idx, col_idx, cell.value)
+  workbook.save(xls_path)
+
+def openpyxl_rows(path, sheet_name):
+  """
+  The rows of a sheet as the checker read them through openpyxl
+  """
+  sheet = openpyxl.reader.excel.load_workbook(path).get_sheet_by_name(sheet_name)
+  return content([[si(x) for x in row] for row in sheet.rows])
+
+class ReaderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.workdir = tempfile.mkdtemp(prefix="share_readers")
+    self.template = os.path.join(self.workdir, "SYNTHETIC Template.xlsx")
+    generate_template(self.template, concepts=2, rows=40, seed=3)
+    # cell types the generated templates don't hold, with gaps between cells and rows
+    self.typed = os.path.join(self.workdir, "TYPED Template.xlsx")
+    workbook = Workbook()
+    sheet = workbook.get_active_sheet()
+    sheet.title = "Typed"
+    sheet.cell("A1").value = u"BRIDG Version"
+    sheet.cell("C1").value = 3
+    sheet.cell("A2").value = 1.5
+    sheet.cell("B2").value = True
+    sheet.cell("D2").value = datetime.datetime(2012, 10, 1, 12, 30)
+    # a time of day alone, a whole number of seconds so openpyxl doesn't round it
+    sheet.cell("E2").value = datetime.time(9, 0)
+    sheet.cell("A5").value = u"  padded  "
+    sheet.cell("E5").value = u"=not a formula"
+    workbook.save(self.typed)
+
+  def tearDown(self):
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def assertReads(self, reader, path):
+    self.assertEqual(reader.sheet_names, openpyxl.reader.excel.load_workbook(path).get_sheet_names())
+    for sheet_name in reader.sheet_names:
+      expected = openpyxl_rows(path, sheet_name)
+      self.assertEqual(content(reader.rows(sheet_name)), expected)
+      self.assertEqual(content(reader.head(sheet_name, 1)), expected[:1])
+
+  def test_xlsx_reader(self):
+    for path in [self.template, self.typed]:
+      self.assertReads(XlsxReader(path), path)
+      with open(path, 'rb') as workbook:
+        self.assertReads(XlsxReader(workbook), path)
+
+  @unittest.skipIf(xlrd is None or xlwt is None, "needs xlrd, and xlwt to write the xls")
+  def test_xlrd_reader(self):
+    for path in [self.template, self.typed]:
+      xls_path = os.path.splitext(path)[0] + ".xls"
+      save_as_xls(path, xls_path)
+      reader = open_workbook(xls_path)
+      self.assertTrue(isinstance(reader, XlrdReader))
+      self.assertReads(reader, path)
+
+  def test_projection(self):
+    reader = XlsxReader(self.template)
+    full = list(reader.rows("Generic"))
+    rows = reader.rows("Generic")
+    self.assertEqual(rows.next(), full[0])
+    # only the projected cells are read from the next row on
+    rows.project(frozenset([0, 2]))
+    for (row, expected) in zip(rows, full[1:]):
+      self.assertEqual(len(row), len(expected))
+      self.assertEqual([row[0], row[2]], [expected[0], expected[2]])
+      self.assertEqual(set(row[3:]), set([u'']))
+
+  def test_open_workbook(self):
+    self.assertTrue(isinstance(open_workbook(self.template), XlsxReader))
+    garbage = os.path.join(self.workdir, "BAD Template.xlsx")
+    with open(garbage, 'wb') as workbook:
+      workbook.write("not a workbook")
+    self.assertRaises(ValueError, open_workbook, garbage)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -3,14 +3,18 @@ from webapp2_extras import sessions
 import os
 import json
 import csv
+import hashlib
 import logging
+import urllib
 
 from google.appengine.ext.webapp import template
 from google.appengine.api import users
 from google.appengine.ext import db
 
-from check_content_sheet import ContentSheetChecker
+from check_content_sheet import ContentSheetChecker, RULESET_VERSION
 from items_to_code_parser import UniqueItemsToCodeParser
+from profiling import INSTANCE_PROFILE
+import tasks
 
 import jinja2
 jinja_environment = jinja2.Environment(
@@ -18,6 +22,21 @@ jinja_environment = jinja2.Environment(
 
 import model
 
+def upload_digest(upload):
+  """
+  Key of an upload in the de-duplication index: its name and bytes, the
+  rule set version and the terminology version, so a change to the rules
+  or the terms misses every earlier upload
+  """
+  upload.file.seek(0)
+  digest = hashlib.sha1(RULESET_VERSION)
+  digest.update("terminology:%s" % model.terminology_version())
+  # the findings are labelled with the template name
+  digest.update((u"name:%s\n" % upload.filename).encode('utf-8'))
+  digest.update(upload.file.read())
+  upload.file.seek(0)
+  return digest.hexdigest()
+
 class BaseHandler(webapp2.RequestHandler):
 
   def dispatch(self):
@@ -57,20 +76,52 @@ class ContentCheckRules(BaseHandler):
   Presents the errors
   """
   def get(self):
+    if self.request.get("format") == "json":
+      self.response.headers["Content-type"] = "application/json"
+      self.response.out.write(INSTANCE_PROFILE.as_json())
+      return
     checker = ContentSheetChecker()
-    template_values = {'rules' : checker.rule_specifications}
+    template_values = {'rules' : checker.rule_specifications,
+                       'profile' : INSTANCE_PROFILE.rows()}
     self.render_jinja("rules", template_values)
 
+# runs listed per page of the findings list
+REPORTS_PAGE_SIZE = 25
+# the columns the findings list can be sorted on
+REPORTS_SORTS = ["date", "sheet", "finding_count", "error_count", "warning_count"]
+
 class ContentCheckReports(BaseHandler):
   """
-  Present the findings
-  TODO: Add column sorting
-  TODO: Add column filtering
-  TODO: Add paging
+  Present the findings: a page of runs at a time, sorted by a column and
+  optionally filtered to a template or to the current user's runs.  The
+  counts are stored on each CheckLog, so a page costs one query
   """
   def get(self):
-    checklogs = model.CheckLog.all().order("-date")
-    self.render_jinja("findings", {"checklogs" : checklogs})
+    sort = self.request.get("sort", "-date")
+    if sort.lstrip("-") not in REPORTS_SORTS:
+      sort = "-date"
+    checklogs = model.CheckLog.all()
+    if self.request.get("sheet"):
+      checklogs.filter("sheet =", self.request.get("sheet"))
+    if self.request.get("mine"):
+      checklogs.filter("opener =", users.get_current_user())
+    checklogs.order(sort)
+    if self.request.get("cursor"):
+      checklogs.with_cursor(self.request.get("cursor"))
+    page = checklogs.fetch(REPORTS_PAGE_SIZE)
+    if len(page) == REPORTS_PAGE_SIZE:
+      cursor = checklogs.cursor()
+    else:
+      cursor = None
+    # the filters, carried over to the sorting and paging links
+    filters = urllib.urlencode({'sheet' : self.request.get("sheet").encode('utf-8'),
+                                'mine' : self.request.get("mine")})
+    self.render_jinja("findings", {"checklogs" : page,
+                                   "sort" : sort,
+                                   "sheet" : self.request.get("sheet"),
+                                   "mine" : self.request.get("mine"),
+                                   "filters" : filters,
+                                   "cursor" : cursor})
         
 class ContentCheckError(BaseHandler):
   """
@@ -89,7 +140,7 @@ class ContentCheckError(BaseHandler):
       logging.exception("No matching CheckLog with id %s" % check_id)
       self.add_message("No matching CheckLog with id %s" % check_id)
       self.render_jinja("contentchecker", {})
-    if checklog.findings.count() == 0:
+    if checklog.issue_count == 0:
       # TODO: error - no errors exist
       logging.exception("CheckLog with id %s has no issues" % check_id)
       self.add_message("CheckLog with id %s has no issues" % check_id)
@@ -102,11 +153,17 @@ class ContentCheckError(BaseHandler):
           self.response.headers['Content-disposition'] = str("attachment;filename=%s" % dest_name)
           writer = csv.writer(self.response.out)
           writer.writerow("Owner|Date|Template|Sheet|Field|Column|Message".split('|'))
-          for issue in [x.as_list() for x in checklog.findings]:
-            writer.writerow(issue)
+          # the CheckLog is resolved once, rather than for every finding
+          for issue in checklog.iter_issues():
+            writer.writerow(issue.as_list(checklog))
         elif self.request.get("format") == "json":
           self.response.headers["Content-type"] = "application/json"
-          self.response.out.write(json.dumps([x.as_dict() for x in checklog.findings]))
+          self.response.out.write("[")
+          for (idx, issue) in enumerate(checklog.iter_issues()):
+            if idx:
+              self.response.out.write(", ")
+            self.response.out.write(json.dumps(issue.as_dict(checklog)))
+          self.response.out.write("]")
         else:
           self.add_message("Format %s not recognised" % self.request.get('format'))
           return self.redirect("/checker/errors/%s" % checker.key().id())
@@ -136,34 +193,78 @@ class ContentChecker(BaseHandler):
       # TODO: Error this
       self.add_message("File name doesn't match pattern")
       self.render_jinja("contentcheck", {})
+    # the same bytes under the same rules were checked recently
+    digest = upload_digest(sheet)
+    previous = tasks.upload_index().get(digest)
+    if previous is not None and model.CheckLog.get_by_id(previous['checklog']) is not None:
+      if previous['issues']:
+        return self.redirect("/content/checker/error/%s" % previous['checklog'])
+      return self.redirect("/content/checker/coffee")
     if users.get_current_user():
-      checklog = model.CheckLog(user=users.get_current_user(), sheet=sheet.filename)
+      checklog = model.CheckLog(opener=users.get_current_user(), sheet=sheet.filename,
+                                status=model.STATUS_QUEUED)
       checklog.put()
     else:
       # TODO: Error this
-      self.redirect("/content/checker")
-    
-    # instantiate the checker
-    checker = ContentSheetChecker()
-    checker.load_from_mem(sheet)
-    if checker.has_issues:
-      # log the issues to the datastore
-      issues = checker.as_dict()
-      findings = []
-      for issue in issues:
-        # log the issues to the datastore and then query them
-        finding = model.ConsistencyFinding(checkrun=checklog,
-                                            template=issue.get('template'),
-                                            tab=issue.get('sheet'),
-                                            field=issue.get('field'),
-                                            column=issue.get('column'),
-                                            message=issue.get('message'))
-        findings.append(finding)
-      # batch put
-      db.put(findings)
-      self.redirect("/content/checker/error/%s" % checklog.key().id())
+      return self.redirect("/content/checker")
+    # the check runs in the background, the user waits on the status page
+    sheet.file.seek(0)
+    model.store_upload(checklog, sheet.file.read())
+    tasks.queue().add("check", checklog_id=checklog.key().id(), digest=digest)
+    self.redirect("/content/checker/status/%s" % checklog.key().id())
+
+class ContentCheckStatus(BaseHandler):
+  """
+  Progress of a background check, as a page polling its JSON form
+  """
+  def get(self, check_id):
+    checklog = model.CheckLog.get_by_id(int(check_id))
+    if checklog is None:
+      self.add_message("No matching CheckLog with id %s" % check_id)
+      return self.redirect("/content/checker")
+    if checklog.is_done:
+      if checklog.finding_count == 0:
+        url = "/content/checker/coffee"
+      else:
+        url = "/content/checker/error/%s" % check_id
     else:
-      self.redirect("/content/checker/coffee")
+      url = None
+    if self.request.get("format") == "json":
+      self.response.headers["Content-type"] = "application/json"
+      self.response.out.write(json.dumps({'status' : checklog.status or model.STATUS_DONE,
+                                          'findings' : checklog.finding_count,
+                                          'url' : url}))
+    elif url is not None:
+      self.redirect(url)
+    else:
+      self.render_jinja("status", {'checklog' : checklog})
+
+class ContentCheckTask(webapp2.RequestHandler):
+  """
+  Runs a background check, posted by the task queue
+  """
+  def post(self):
+    tasks.check_upload(self.request.get("checklog_id"), self.request.get("digest"))
+
+class RekeyTerminologyTask(webapp2.RequestHandler):
+  """
+  Moves terms stored under ids to their key names, a batch per task
+  """
+  def post(self):
+    tasks.rekey_terminology(self.request.get("cursor"))
+
+class MigrateFindingsTask(webapp2.RequestHandler):
+  """
+  Moves stored runs to blob storage of their findings, a batch per task
+  """
+  def get(self):
+    # started by an admin, the tasks carry on from there
+    tasks.queue().add("migrate")
+    tasks.queue().add("rekey_terminology")
+    self.response.out.write("Migration of findings and terminology started")
+
+  def post(self):
+    tasks.migrate_findings(self.request.get("cursor"))
       
 class ContentGenericRenderer(BaseHandler):
   
@@ -181,9 +282,9 @@ class TerminologyHandler(BaseHandler):
     TODO: Query by terminology type (bridg, etc)
     """
     try:
-      coding = model.CodedTerminology.get_by_id(int(key))
+      coding = model.CodedTerminology.get(key)
       self.render_jinja("code_modify", {'code' : coding})
-    except ValueError, e:
+    except db.BadKeyError, e:
       logging.exception("Loading code failed: %s" % e)
       self.redirect("/terminology/codes")
 
@@ -191,37 +292,36 @@ class TerminologyHandler(BaseHandler):
     code_name = self.request.POST["code_name"]
     code_code = self.request.POST["code_code"]
     code_context = self.request.POST["code_context"]
-    code = model.CodedTerminology.get_by_id(int(key))
+    code = model.CodedTerminology.get(key)
     code.code = code_code
     code.terminology_sheet = code_context
     code.put()
+    model.bump_terminology_version()
     self.redirect("/terminology/codes")
     
 class BulkTerminologyHandler(BaseHandler):
   
   def get(self):
     """
-    Report the terminology
-    TODO: Paging
-    TODO: Query by terminology name (starts_with)
-    TODO: Query by terminology type (bridg, etc)
+    Report the terminology, a page at a time: the terms starting with q (in
+    any case) in the filter context, as a page or as JSON for searching as
+    you type
     """
-    try:
-      if self.request.get('filter'):
-        if self.request.get('filter').upper() in ['BRIDG', 'VAR']: 
-          coding = model.CodedTerminology.gql("WHERE terminology_type = :1 ORDER BY name", str(self.request.get('filter')).upper())
-        elif self.request.get('filter').upper() in ['TODO']: 
-          coding = model.CodedTerminology.gql("WHERE code in ('CNEW', NULL, '') ORDER BY name")
-        elif self.request.get('filter').upper() in ['NA']: 
-          coding = model.CodedTerminology.gql("WHERE code in ('N/A', 'NA') ORDER BY name")
-        else:
-          coding = model.CodedTerminology.all().order("name")
-      else:
-        coding = model.CodedTerminology.all().order("name")
-    except TypeError, e:
-      logging.exception("Type error raised: %s" % e)
-      coding = []
-    self.render_jinja("codes", {'codesets' : coding})
+    prefix = self.request.get('q')
+    context = self.request.get('filter').upper()
+    # cached until a term is changed, so most views don't touch the datastore
+    page = model.terminology_view(prefix, context, self.request.get('cursor') or None)
+    if self.request.get("format") == "json":
+      self.response.headers["Content-type"] = "application/json"
+      self.response.out.write(json.dumps(page))
+      return
+    # the search, carried over to the paging links
+    filters = urllib.urlencode({'q' : prefix.encode('utf-8'), 'filter' : context})
+    self.render_jinja("codes", {'codesets' : page['terms'],
+                                'q' : prefix,
+                                'filter' : context,
+                                'filters' : filters,
+                                'cursor' : page['cursor']})
   
 class BulkTerminologyUploadHandler(BaseHandler):
   
@@ -237,29 +337,10 @@ class BulkTerminologyUploadHandler(BaseHandler):
       # TODO: Error this
       logging.exception("Response object not as expected")
       self.render_jinja("codes", {})
-    # load existing codes
-    codes = [x.as_dict() for x in model.CodedTerminology.all()]
-    term_loader = UniqueItemsToCodeParser(codes)
+    term_loader = UniqueItemsToCodeParser()
     terminology = term_loader.load_from_mem(sheet)
-    logging.exception("Terminology: %s" % terminology)
-    to_merge = []
-    for (term, properties) in terminology.iteritems():
-      code = properties.get('code', "")
-      term_type = properties.get('terminology_type', '')
-      _term = model.CodedTerminology.gql("WHERE name=:1", term).get()
-      if _term:
-        if _term.code != code:
-          _term.code = code
-          to_merge.append(_term)
-        if _term.terminology_type != term_type:
-          _term.terminology_type = term_type
-          to_merge.append(_term)
-      else:
-        _term = model.CodedTerminology(name=term, 
-              code=properties['code'],
-              terminology_type=properties['terminology_type'])
-        logging.exception("New Terminology: %s" % _term)
-        to_merge.append(_term)
-    db.put(to_merge)
+    # terms are fetched by key in batches, and only the changes written
+    changed = model.merge_terminology(terminology)
+    logging.info("Terminology: %s terms uploaded, %s changed" % (len(terminology), changed))
     self.redirect("/terminology/codes")
     
\ No newline at end of file
@@ -17,13 +17,17 @@ class MainPage(webapp2.RequestHandler):
 routes = [('/', MainPage),
           ('/content/checker[/]?', view.ContentChecker),
           ('/content/checker/error/(\d+)', view.ContentCheckError),
+          ('/content/checker/status/(\d+)[/]?', view.ContentCheckStatus),
           ('/content/checker/rules[/]?', view.ContentCheckRules),
           ('/content/checker/findings[/]?', view.ContentCheckReports),
           ('/content/checker/coffee', view.CoffeeTime),
           ('/terminology[/]?', view.BulkTerminologyHandler),
           ('/terminology/upload[/]?', view.BulkTerminologyUploadHandler),
           ('/terminology/codes[/]?', view.BulkTerminologyHandler),
-          ('/terminology/code/(\d+)[/]?', view.TerminologyHandler),
+          ('/terminology/code/([^/]+)[/]?', view.TerminologyHandler),
+          ('/tasks/check', view.ContentCheckTask),
+          ('/tasks/migrate', view.MigrateFindingsTask),
+          ('/tasks/rekey_terminology', view.RekeyTerminologyTask),
           ]
 
 config = {}